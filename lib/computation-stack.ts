@@ -180,8 +180,11 @@ export class ComputationStack extends cdk.Stack {
 
     let ALGORITHMS = ["cosinor", "differential_cosinor", "ls", "arser", "jtk", "one_way_anova", "two_way_anova", "rain", "upside"];
 
+    // Runs several analyses of the same spreadsheets, listed in $.analyses, together
+    let ALL_ALGORITHMS = "all";
+
     let computationLambdas = new Map<string, lambda.DockerImageFunction>();
-    for (let algorithm of ALGORITHMS) {
+    for (let algorithm of [ALL_ALGORITHMS, ...ALGORITHMS]) {
       computationLambdas.set(
         algorithm,
         new lambda.DockerImageFunction(
@@ -193,7 +196,10 @@ export class ComputationStack extends cdk.Stack {
             code: lambda.DockerImageCode.fromImageAsset(
               path.join(__dirname, "../src/computation"),
               {
-                file: `algorithms/${algorithm}/Dockerfile`,
+                file:
+                  algorithm === ALL_ALGORITHMS
+                    ? "algorithms/Dockerfile"
+                    : `algorithms/${algorithm}/Dockerfile`,
               }
             ),
             environment: {
@@ -240,7 +246,9 @@ export class ComputationStack extends cdk.Stack {
       algorithmComputationTask,
     ] of computationTasks.entries()) {
       algorithmChoice.when(
-        sfn.Condition.stringEquals("$.algorithm", algorithm),
+        algorithm === ALL_ALGORITHMS
+          ? sfn.Condition.isPresent("$.analyses")
+          : sfn.Condition.stringEquals("$.algorithm", algorithm),
         algorithmComputationTask
       );
     }
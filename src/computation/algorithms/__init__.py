@@ -1,4 +1,7 @@
 import importlib
+import numpy as np
+
+from utilities import BlockData
 
 ALGORITHMS = ["cosinor", "differential_cosinor", "ls", "arser", "jtk", "one_way_anova", "two_way_anova", "rain", "upside"]
 COMPARISON_ALGORITHMS = ["differential_cosinor", "two_way_anova", "upside"]
@@ -8,3 +11,55 @@ def compute(algorithm):
         raise NotImplementedError
 
     return importlib.import_module(f"algorithms.{algorithm}").algorithm
+
+
+def operates_on_blocks(algorithm):
+    """
+    Mark `algorithm` as taking a contiguous 2-D block of rows, or for the comparison
+    algorithms a tuple of blocks with the same rows of each spreadsheet, and returning
+    NumPy arrays with the results of each row of the block
+
+    Unmarked algorithms take an iterable of rows, or of tuples of rows, and return lists.
+    """
+
+    algorithm.operates_on_blocks = True
+    return algorithm
+
+
+def shares_block_data(algorithm):
+    """
+    Mark `algorithm`, operating on blocks, as taking as `block_data` the BlockData of
+    `data`, then processed as a single block, so that what it derives from the rows is
+    computed once for all the algorithms run on them
+    """
+
+    algorithm.shares_block_data = True
+    return algorithm
+
+
+def blocks(data, size):
+    """
+    Consecutive blocks of at most `size` rows of the 2-D array `data`, or tuples of
+    such blocks for a tuple of arrays with the same rows
+    """
+
+    if isinstance(data, tuple):
+        yield from zip(*(blocks(array, size) for array in data))
+        return
+
+    for start in range(0, len(data), size):
+        yield np.asarray(data[start : start + size], dtype=float)
+
+
+def blocks_with_data(data, size, block_data=None):
+    """
+    Consecutive blocks of at most `size` rows of the 2-D array `data`, each with its
+    BlockData, or `data` as a single block with `block_data` when it is given
+    """
+
+    if block_data is not None:
+        yield np.asarray(data, dtype=float), block_data
+        return
+
+    for block in blocks(data, size):
+        yield block, BlockData(block)
@@ -1,9 +1,11 @@
 import numpy as np
-import rpy2.robjects as R
-import statsmodels.api as sm
 
-from itertools import chain
-from scipy.signal import argrelextrema, detrend, savgol_filter
+from collections import defaultdict
+from functools import lru_cache
+from scipy.signal import detrend, savgol_filter
+from scipy.stats import f
+
+from algorithms import blocks, operates_on_blocks
 
 START_PERIOD = 20
 DEFAULT_PERIOD = 24
@@ -11,16 +13,12 @@ END_PERIOD = 28
 
 NUMBER_OF_FREQUENCIES_AT_WHICH_TO_ESTIMATE_THE_SPECTRAL_DENSITY = 500
 
-ε = 1e-15
+BATCH_SIZE = 1_000
 
-spec_ar = R.r["spec.ar"]
+ε = 1e-15
 
 
-def valid_input(y, sample_collection_times):
-    # No missing values
-    if any(np.isnan(y)):
-        return False
-
+def valid_input(sample_collection_times):
     # Only one replicate per timepoint
     if len(sample_collection_times) != len(set(sample_collection_times)):
         return False
@@ -36,91 +34,231 @@ def valid_input(y, sample_collection_times):
     return True
 
 
+@operates_on_blocks
 def arser(data, sample_collection_times):
-    autoregressive_model_parameters_estimation_methods = ["yule-walker", "mle", "burg"]
+    timepoints = sample_collection_times
+    valid_timepoints = valid_input(timepoints)
 
     p = []
-    for y in data:
-        if not valid_input(y, sample_collection_times):
-            p.append(np.nan)
-            continue
 
-        timepoints = sample_collection_times
+    for y in blocks(data, BATCH_SIZE):
+        P = np.full(len(y), np.nan)
+
+        # No missing values
+        valid = np.all(np.isfinite(y), axis=1) & valid_timepoints
 
-        y = detrend(y, type="linear")
+        if np.any(valid):
+            P[valid] = arser_p_values(detrend(y[valid], type="linear", axis=1), timepoints)
 
-        if np.var(y) < ε:
-            p.append(1.0)
-            continue
+        p.extend(P)
 
-        models = []
-        for smoothing in [True, False]:
-            for method in autoregressive_model_parameters_estimation_methods:
-                cycling_periods = [
-                    period
-                    for period in estimate_cycling_periods(
-                        y, timepoints, method, smoothing
-                    )
-                    if START_PERIOD <= period <= END_PERIOD
-                ]
+    return [np.array(p)]
 
-                if not cycling_periods:
-                    cycling_periods = [DEFAULT_PERIOD]
 
-                x = np.concatenate(
-                    (
-                        [np.cos(2 * np.pi / T * timepoints) for T in cycling_periods],
-                        [np.sin(2 * np.pi / T * timepoints) for T in cycling_periods],
-                    )
-                ).T
+def arser_p_values(y, timepoints):
+    """p-values of the harmonic models selected by AIC for the detrended rows of `y`"""
 
-                models.append(sm.OLS(y, sm.add_constant(x)).fit())
+    autoregressive_model_parameters_estimation_methods = ["yule-walker", "burg"]
 
-        # Select models by AIC
-        best_model = min(models, key=lambda model: model.aic)
-        p.append(best_model.f_pvalue)
+    P = np.ones(len(y))
 
-    return [p]
+    cycling = np.var(y, axis=1) >= ε
+    if not np.any(cycling):
+        return P
+
+    y = y[cycling]
+
+    aic, f_p_values = [], []
+    for smoothing in [True, False]:
+        for method in autoregressive_model_parameters_estimation_methods:
+            cycling_periods = [
+                [period for period in periods if START_PERIOD <= period <= END_PERIOD]
+                or [DEFAULT_PERIOD]
+                for periods in estimate_cycling_periods(y, timepoints, method, smoothing)
+            ]
+
+            model_aic, model_f_p_values = harmonic_regression(y, timepoints, cycling_periods)
+            aic.append(model_aic)
+            f_p_values.append(model_f_p_values)
+
+    # Select models by AIC
+    P[cycling] = np.choose(np.argmin(aic, axis=0), f_p_values)
+
+    return P
 
 
 def estimate_cycling_periods(y, timepoints, parameters_estimation_method, smoothing):
+    """
+    Periods of the peaks of the maximum entropy spectral density estimates of the
+    rows of `y`, as given by R's spec.ar, by decreasing spectral density
+    """
+
     Δt = timepoints[1] - timepoints[0]
     autoregressive_model_order = round(24 // Δt)
     if autoregressive_model_order == timepoints.size:
         autoregressive_model_order = timepoints.size // 2
 
+    if not 1 <= autoregressive_model_order < timepoints.size:
+        raise ValueError(
+            f"The order {autoregressive_model_order} of the autoregressive model "
+            f"should be between 1 and {timepoints.size - 1}."
+        )
+
     if smoothing:
         try:
-            y = savgol_filter(y, window_length=11, polyorder=4)
-        except:
-            y = savgol_filter(y, window_length=5, polyorder=2)
-
-    maximum_entropy_spectral_density_estimate = spec_ar(
-        R.FloatVector(y),
-        method=parameters_estimation_method,
-        order=autoregressive_model_order,
-        n_freq=NUMBER_OF_FREQUENCIES_AT_WHICH_TO_ESTIMATE_THE_SPECTRAL_DENSITY,
-        plot=False,
+            y = savgol_filter(y, window_length=11, polyorder=4, axis=1)
+        except ValueError:
+            y = savgol_filter(y, window_length=5, polyorder=2, axis=1)
+
+    if parameters_estimation_method == "yule-walker":
+        coefficients = yule_walker(y, autoregressive_model_order)
+    else:
+        coefficients = burg(y, autoregressive_model_order)
+
+    frequencies = np.linspace(
+        0, 0.5, NUMBER_OF_FREQUENCIES_AT_WHICH_TO_ESTIMATE_THE_SPECTRAL_DENSITY
     )
+    lags = np.arange(1, autoregressive_model_order + 1)
 
-    frequencies = np.array(maximum_entropy_spectral_density_estimate.rx2("freq"))
-    spectral_density = np.array(
-        maximum_entropy_spectral_density_estimate.rx2("spec")
-    ).reshape(NUMBER_OF_FREQUENCIES_AT_WHICH_TO_ESTIMATE_THE_SPECTRAL_DENSITY)
+    # Up to the variance of the innovations, which does not move the peaks
+    spectral_density = 1 / (
+        (1 - coefficients @ np.cos(2 * np.pi * np.outer(lags, frequencies))) ** 2
+        + (coefficients @ np.sin(2 * np.pi * np.outer(lags, frequencies))) ** 2
+    )
 
-    indices_of_local_maxima_of_spectral_density = argrelextrema(
-        spectral_density, np.greater
-    )[0]
+    local_maxima = np.zeros(spectral_density.shape, dtype=bool)
+    local_maxima[:, 1:-1] = (spectral_density[:, 1:-1] > spectral_density[:, :-2]) & (
+        spectral_density[:, 1:-1] > spectral_density[:, 2:]
+    )
+
+    periods = []
+    for i in range(len(y)):
+        indices_of_local_maxima_of_spectral_density = np.flatnonzero(local_maxima[i])
 
-    sorted_by_spectral_density_values = spectral_density[
-        indices_of_local_maxima_of_spectral_density
-    ].argsort()[::-1]
+        sorted_by_spectral_density_values = spectral_density[
+            i, indices_of_local_maxima_of_spectral_density
+        ].argsort()[::-1]
 
-    periods = Δt / (
-        frequencies[
-            indices_of_local_maxima_of_spectral_density[
-                sorted_by_spectral_density_values
+        periods.append(
+            Δt
+            / frequencies[
+                indices_of_local_maxima_of_spectral_density[sorted_by_spectral_density_values]
             ]
-        ]
-    )
+        )
+
     return periods
+
+
+def yule_walker(y, order):
+    """Yule-Walker estimates of the coefficients of autoregressive models of the rows of `y`"""
+
+    x = y - y.mean(axis=1, keepdims=True)
+    n = x.shape[1]
+
+    autocovariances = np.array(
+        [np.sum(x[:, : n - k] * x[:, k:], axis=1) / n for k in range(order + 1)]
+    ).T
+
+    lags = np.arange(order)
+    toeplitz = autocovariances[:, np.abs(lags[:, np.newaxis] - lags)]
+
+    return np.linalg.solve(toeplitz, autocovariances[:, 1:, np.newaxis])[..., 0]
+
+
+def burg(y, order):
+    """
+    Burg estimates of the coefficients of autoregressive models of the rows of `y`,
+    with the recursion of R's ar.burg
+    """
+
+    x = y - y.mean(axis=1, keepdims=True)
+    n = x.shape[1]
+
+    coefficients = np.zeros((len(x), order))
+
+    u = x[:, ::-1].copy()
+    v = x[:, ::-1].copy()
+
+    for p in range(1, order + 1):
+        reflection_coefficient = (
+            2
+            * np.sum(v[:, p:] * u[:, p - 1 : -1], axis=1)
+            / np.sum(v[:, p:] ** 2 + u[:, p - 1 : -1] ** 2, axis=1)
+        )
+
+        if p > 1:
+            coefficients[:, : p - 1] -= (
+                reflection_coefficient[:, np.newaxis] * coefficients[:, p - 2 :: -1]
+            )
+        coefficients[:, p - 1] = reflection_coefficient
+
+        u[:, p:], v[:, p:] = (
+            u[:, p - 1 : n - 1] - reflection_coefficient[:, np.newaxis] * v[:, p:],
+            v[:, p:] - reflection_coefficient[:, np.newaxis] * u[:, p - 1 : n - 1],
+        )
+
+    return coefficients
+
+
+def harmonic_regression(y, timepoints, cycling_periods):
+    """
+    AIC and F-test p-values of the least squares fits of the rows of `y` to harmonic
+    models with the given cycling periods, as reported by statsmodels' OLS
+
+    Rows with the same set of cycling periods share the design, whose factorization
+    is cached, and are solved together.
+    """
+
+    n = timepoints.size
+
+    rows_by_cycling_periods = defaultdict(list)
+    for i, periods in enumerate(cycling_periods):
+        rows_by_cycling_periods[tuple(sorted(float(period) for period in periods))].append(i)
+
+    residual_sum_of_squares = np.empty(len(y))
+    rank = np.empty(len(y), dtype=int)
+
+    for periods, rows in rows_by_cycling_periods.items():
+        basis, rank[rows] = harmonic_design_basis(periods, tuple(timepoints.tolist()))
+        residual_sum_of_squares[rows] = np.sum(
+            (y[rows] - (y[rows] @ basis) @ basis.T) ** 2, axis=1
+        )
+
+    total_sum_of_squares = np.sum((y - y.mean(axis=1, keepdims=True)) ** 2, axis=1)
+
+    degrees_of_freedom_of_the_model = rank - 1
+    degrees_of_freedom_of_the_residuals = n - rank
+
+    log_likelihood = -n / 2 * (np.log(2 * np.pi * residual_sum_of_squares / n) + 1)
+    aic = -2 * log_likelihood + 2 * rank
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        F = (
+            (total_sum_of_squares - residual_sum_of_squares)
+            / degrees_of_freedom_of_the_model
+            / (residual_sum_of_squares / degrees_of_freedom_of_the_residuals)
+        )
+
+    return aic, f.sf(F, degrees_of_freedom_of_the_model, degrees_of_freedom_of_the_residuals)
+
+
+@lru_cache(maxsize=1_024)
+def harmonic_design_basis(cycling_periods, timepoints):
+    """
+    Orthonormal basis of the column space of the design of the harmonic model with the
+    given cycling periods, from its QR factorization, and the rank of the design
+
+    The basis of a rank deficient design, which statsmodels' pseudo-inverse fits in
+    its column space, is made of its leading left singular vectors instead.
+    """
+
+    ωt = 2 * np.pi / np.array(cycling_periods)[:, np.newaxis] * np.array(timepoints)
+    design = np.concatenate((np.ones((1, len(timepoints))), np.cos(ωt), np.sin(ωt))).T
+
+    rank = np.linalg.matrix_rank(design)
+    if rank == design.shape[1]:
+        basis = np.linalg.qr(design)[0]
+    else:
+        basis = np.linalg.svd(design, full_matrices=False)[0][:, :rank]
+
+    return basis, rank
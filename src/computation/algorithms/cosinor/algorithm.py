@@ -1,10 +1,19 @@
 import numpy as np
-import statsmodels.api as sm
 
-from utilities import enough_timepoints, remove_missing_values
+from functools import lru_cache
+from scipy.stats import f
 
+from algorithms import blocks_with_data, operates_on_blocks, shares_block_data
+from utilities import enough_timepoints
 
-def cosinor(data, sample_collection_times, cycle_length=24):
+BATCH_SIZE = 1_000
+
+DEGREES_OF_FREEDOM_OF_THE_MODEL = 2
+
+
+@operates_on_blocks
+@shares_block_data
+def cosinor(data, sample_collection_times, cycle_length=24, periods=None, block_data=None):
     """
     Fit data to cosinor model with parameters x₀, x₁, x₂:
 
@@ -12,31 +21,188 @@ def cosinor(data, sample_collection_times, cycle_length=24):
 
     Germaine Cornelissen, ”Cosinor-based rhythmometry”,
     Theoretical Biology and Medical Modelling 11:16 (2014)
+
+    Rows are fitted in batches; rows sharing the same missing values
+    share the design matrix and are solved together.
+
+    If candidate `periods` are given, each row is fitted at the best of them
+    instead of at `cycle_length`, see cosinor_period_scan.
     """
 
+    if periods is not None:
+        return cosinor_period_scan(data, sample_collection_times, periods, block_data)
+
     ω = 2 * np.pi / cycle_length
     x, p = [], []
 
-    for y in data:
-        y, t = remove_missing_values(y, sample_collection_times)
-
-        if not enough_timepoints(t, cycle_length):
-            x.append([np.nan, np.nan, np.nan])
-            p.append(np.nan)
-            continue
-
-        fit = sm.OLS(
-            y,
-            np.array(
-                [
-                    np.repeat(1.0, t.size),
-                    np.cos(ω * t),
-                    np.sin(ω * t),
-                ]
-            ).T,
-        ).fit()
-
-        x.append(fit.params.tolist())
-        p.append(fit.f_pvalue)
-
-    return x, p
+    for y, block_data in blocks_with_data(data, BATCH_SIZE, block_data):
+        X = np.full((len(y), 3), np.nan)
+        F = np.full(len(y), np.nan)
+        degrees_of_freedom_of_the_residuals = np.zeros(len(y))
+
+        for group in block_data.grouping:
+            if not group.has_enough_timepoints(sample_collection_times, cycle_length):
+                continue
+
+            t = sample_collection_times[group.mask]
+            X[group.indices], F[group.indices] = fit(y[np.ix_(group.indices, group.mask)], t, ω)
+            degrees_of_freedom_of_the_residuals[group.indices] = t.size - 3
+
+        x.extend(X)
+        p.extend(
+            f.sf(
+                F,
+                DEGREES_OF_FREEDOM_OF_THE_MODEL,
+                degrees_of_freedom_of_the_residuals,
+            )
+        )
+
+    return np.array(x), np.array(p)
+
+
+def fit(y, t, ω):
+    """
+    Least squares fit of the rows of `y` sharing the sampling times `t`
+
+    Returns the parameters and the F statistic of each row. The design has
+    full column rank whenever there are enough timepoints, so its
+    pseudo-inverse is (XᵀX)⁻¹Xᵀ.
+    """
+
+    design = np.array([np.repeat(1.0, t.size), np.cos(ω * t), np.sin(ω * t)]).T
+    pseudo_inverse = np.linalg.solve(design.T @ design, design.T)
+
+    mean = y.mean(axis=1, keepdims=True)
+    r = y - mean
+
+    x = r @ pseudo_inverse.T
+    x[:, :1] += mean
+
+    residual_sum_of_squares = np.sum((y - x @ design.T) ** 2, axis=1)
+    total_sum_of_squares = np.sum(r**2, axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        F = (
+            (total_sum_of_squares - residual_sum_of_squares)
+            / DEGREES_OF_FREEDOM_OF_THE_MODEL
+        ) / (residual_sum_of_squares / (t.size - 3))
+
+    # Flat rows are not rhythmic, but rows of zeros have always been reported as NaN
+    flat = np.all(y == y[:, :1], axis=1)
+    F[flat] = np.where(y[flat, 0] != 0, 0, np.nan)
+
+    return x, F
+
+
+def cosinor_period_scan(data, sample_collection_times, periods, block_data=None):
+    """
+    Fit data to the cosinor model at each of the candidate `periods` and keep the
+    best fit of each row, the one with the largest F statistic
+
+    Returns the parameters of the best fits, their p-values with a Bonferroni
+    adjustment for the number of periods tested, and the best periods.
+    """
+
+    periods = tuple(float(period) for period in periods)
+    x, p, best_periods = [], [], []
+
+    for y, block_data in blocks_with_data(data, BATCH_SIZE, block_data):
+        X = np.full((len(y), 3), np.nan)
+        F = np.full(len(y), np.nan)
+        best_period = np.full(len(y), np.nan)
+        degrees_of_freedom_of_the_residuals = np.zeros(len(y))
+        number_of_tested_periods = np.zeros(len(y))
+
+        for group in block_data.grouping:
+            t = sample_collection_times[group.mask]
+
+            tested_periods, bases, pseudo_inverses = scan_designs(tuple(t.tolist()), periods)
+            if tested_periods.size == 0:
+                continue
+
+            X[group.indices], F[group.indices], best = scan(
+                y[np.ix_(group.indices, group.mask)], bases, pseudo_inverses
+            )
+            best_period[group.indices] = tested_periods[best]
+            degrees_of_freedom_of_the_residuals[group.indices] = t.size - 3
+            number_of_tested_periods[group.indices] = tested_periods.size
+
+        x.extend(X)
+        p.extend(
+            np.minimum(
+                1,
+                number_of_tested_periods
+                * f.sf(F, DEGREES_OF_FREEDOM_OF_THE_MODEL, degrees_of_freedom_of_the_residuals),
+            )
+        )  # Bonferroni adjustment
+        best_periods.extend(best_period)
+
+    return np.array(x), np.array(p), np.array(best_periods)
+
+
+def scan(y, bases, pseudo_inverses):
+    """
+    Parameters and F statistics of the best fits of the rows of `y`, sharing their
+    sampling times, among their fits at all the periods of the designs given by
+    scan_designs, and the indices of the periods of the best fits
+
+    The rows are fitted at all the periods with two matrix products.
+    """
+
+    number_of_values = y.shape[1]
+    number_of_periods = len(pseudo_inverses)
+
+    mean = y.mean(axis=1, keepdims=True)
+    r = y - mean
+
+    # Sums of squares explained by the cosine and sine of each period
+    model_sum_of_squares = np.sum(
+        (r @ bases).reshape(len(y), number_of_periods, 2) ** 2, axis=2
+    )
+    total_sum_of_squares = np.sum(r**2, axis=1, keepdims=True)
+    residual_sum_of_squares = np.maximum(total_sum_of_squares - model_sum_of_squares, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        F = (model_sum_of_squares / DEGREES_OF_FREEDOM_OF_THE_MODEL) / (
+            residual_sum_of_squares / (number_of_values - 3)
+        )
+
+    best = np.argmax(np.where(np.isnan(F), -np.inf, F), axis=1)
+
+    x = np.einsum("in,ikn->ik", r, pseudo_inverses[best])
+    x[:, :1] += mean
+
+    F = F[np.arange(len(y)), best]
+
+    # Flat rows are not rhythmic, but rows of zeros have always been reported as NaN
+    flat = np.all(y == y[:, :1], axis=1)
+    F[flat] = np.where(y[flat, 0] != 0, 0, np.nan)
+
+    return x, F, best
+
+
+@lru_cache(maxsize=1_024)
+def scan_designs(t, periods):
+    """
+    Periods among `periods` at which the sampling times `t` cover enough timepoints,
+    with the orthonormal bases of the centered cosines and sines of these periods
+    at `t`, side by side, and the pseudo-inverses of the designs of the cosinor
+    model at each of them
+    """
+
+    t = np.array(t)
+    periods = np.array([period for period in periods if enough_timepoints(t, period)])
+
+    if periods.size == 0:
+        return periods, None, None
+
+    ωt = 2 * np.pi / periods[:, np.newaxis] * t
+    designs = np.stack([np.ones(ωt.shape), np.cos(ωt), np.sin(ωt)], axis=2)
+
+    centered = designs[:, :, 1:] - designs[:, :, 1:].mean(axis=1, keepdims=True)
+    bases = np.linalg.qr(centered)[0].transpose(1, 0, 2).reshape(t.size, 2 * periods.size)
+
+    designs_transposed = designs.transpose(0, 2, 1)
+    pseudo_inverses = np.linalg.solve(designs_transposed @ designs, designs_transposed)
+
+    return periods, bases, pseudo_inverses
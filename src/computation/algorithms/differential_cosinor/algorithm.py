@@ -1,10 +1,13 @@
 import numpy
-import scipy
-
-import statsmodels.api as sm
+import scipy.stats
 
 from numpy import cos, sin
 
+from algorithms import blocks, operates_on_blocks
+from utilities import group_by_missing_values
+
+BATCH_SIZE = 1_000
+
 
 def cosinor_analysis(timepoints_A, data_A, timepoints_B, data_B, timepoints_per_cycle):
     '''
@@ -18,8 +21,8 @@ def cosinor_analysis(timepoints_A, data_A, timepoints_B, data_B, timepoints_per_
             containing the values of the condition B
 
     returns:
-        p-values for equality of amplitude between data sets
-        p-values for equality of acrophase (peak time)
+        array of p-values for equality of amplitude between data sets
+        array of p-values for equality of acrophase (peak time)
 
     Tests performed in this method are based off the following publication:
     Bingham, Arbogast, Cornelissen Guillaume, Lee, Halberg "Inferential Statistical Methods for Estimating and Comparing Cosinor Parameters" 1982
@@ -69,35 +72,20 @@ def cosinor_analysis(timepoints_A, data_A, timepoints_B, data_B, timepoints_per_
     # Fitting to the model
     # y ~ beta * cos(t) + gamma * sin(t) + M + epsilon
     # solving for beta, gamma, M with residual epsilon being normally distributed
+    # for all features sharing the same missing values at once
 
-    p_amplitude = numpy.ones(num_features)
-    p_phase = numpy.ones(num_features)
-    for i in range(num_features):
-        # Number of samples in each dataset
-        # after dropping NaNs
-        N_A = numpy.isfinite(data_A[i]).sum()
-        N_B = numpy.isfinite(data_B[i]).sum()
-        N = N_A + N_B
-        DoF = N - 6
-
-        if DoF < 1:
-            # Skip row - too many missing values
-            p_amplitude[i] = float("NaN")
-            p_phase[i] = float("NaN")
-            continue
-
-        # For each feature, perform Least-Squares fits
-
-        res_A = sm.OLS(data_A[i], predictor_A, missing='drop').fit()
-        res_B = sm.OLS(data_B[i], predictor_B, missing='drop').fit()
-        x_A = res_A.params
-        resid_A = (res_A.resid**2).sum()
-        x_B = res_B.params
-        resid_B = (res_B.resid**2).sum()
+    x_A, resid_A, N_A = least_squares_fit(predictor_A, data_A)
+    x_B, resid_B, N_B = least_squares_fit(predictor_B, data_B)
 
+    # Number of samples in each dataset
+    # after dropping NaNs
+    N = N_A + N_B
+    DoF = N - 6
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
         # Best-fit parameters
-        beta_A, gamma_A, M_A = x_A
-        beta_B, gamma_B, M_B = x_B
+        beta_A, gamma_A, M_A = x_A.T
+        beta_B, gamma_B, M_B = x_B.T
 
         # Amplitudes
         amp_A = numpy.sqrt(beta_A**2 + gamma_A**2)
@@ -123,28 +111,60 @@ def cosinor_analysis(timepoints_A, data_A, timepoints_B, data_B, timepoints_per_
         ## EQUAL VARIANCES BETWEEN DATA_A AND DATA_B case:
         # # Approximate test for equality of amplitudes
         # t_amplitude = numpy.abs(amp_A - amp_B) / (sigma * numpy.sqrt(c22_phi_A + c22_phi_B))
-        # p_amplitude[i] = 2*scipy.stats.t.sf(t_amplitude, DoF)
+        # p_amplitude = 2*scipy.stats.t.sf(t_amplitude, DoF)
 
         # # Approximate test for equality of phases
         # t_phase = numpy.abs(beta_A*gamma_B - beta_B*gamma_A) / (sigma * numpy.sqrt(amp_B**2*c33_phi_A + amp_A**2*c33_phi_B))
-        # p_phase[i] = 2*scipy.stats.t.sf(t_phase, DoF)
+        # p_phase = 2*scipy.stats.t.sf(t_phase, DoF)
 
         ## Unequal variances allowed (with approximate DoF calculated)
         # Approximate test for equality of amplitudes
         t_amplitude = numpy.abs(amp_A - amp_B) / numpy.sqrt(c22_phi_A*sigma_sq_A + c22_phi_B*sigma_sq_B)
         rho = c22_phi_B*sigma_sq_B/(c22_phi_A*sigma_sq_A)
         dof = (1 + rho)**2/(1/(N_A-3) + rho**2/(N_B-3))
-        p_amplitude[i] = 2*scipy.stats.t.sf(t_amplitude, dof)
+        p_amplitude = 2*scipy.stats.t.sf(t_amplitude, dof)
 
         # Approximate test for equality of amplitudes
         t_phase = numpy.abs(beta_A*gamma_B - beta_B*gamma_A) / numpy.sqrt(amp_B**2*c33_phi_A*sigma_sq_A + amp_A**2*c33_phi_B*sigma_sq_B)
         rho = (amp_A**2*c33_phi_B*sigma_sq_B) / (amp_B**2*c33_phi_A*sigma_sq_A**2)
         dof = (1 + rho)**2/(1/(N_A-3) + rho**2/(N_B-3))
-        p_phase[i] = 2*scipy.stats.t.sf(t_phase, dof)
+        p_phase = 2*scipy.stats.t.sf(t_phase, dof)
+
+    # Skip rows with too many missing values
+    skip = (DoF < 1) | (N_A == 0) | (N_B == 0)
+    p_amplitude[skip] = float("NaN")
+    p_phase[skip] = float("NaN")
+
+    return p_amplitude, p_phase
+
+
+def least_squares_fit(predictor, data):
+    '''
+    Least-squares fits of all rows of `data`, dropping missing values
+
+    Rows sharing the same missing values share the pseudo-inverse of the predictor.
+
+    returns:
+        best-fit parameters, of shape (num_features, 3)
+        sums of squared residuals
+        numbers of samples after dropping NaNs
+    '''
 
-    return p_amplitude[0], p_phase[0]
+    x = numpy.zeros((data.shape[0], predictor.shape[1]))
+    resid = numpy.zeros(data.shape[0])
+    N = numpy.zeros(data.shape[0], dtype=int)
 
+    for group in group_by_missing_values(data):
+        y = data[numpy.ix_(group.indices, group.mask)]
 
+        x[group.indices] = y @ numpy.linalg.pinv(predictor[group.mask]).T
+        resid[group.indices] = ((y - x[group.indices] @ predictor[group.mask].T)**2).sum(axis=1)
+        N[group.indices] = group.mask.sum()
+
+    return x, resid, N
+
+
+@operates_on_blocks
 def differential_cosinor(data, sample_collection_times, cycle_length=24):
     
     groups = []
@@ -158,14 +178,14 @@ def differential_cosinor(data, sample_collection_times, cycle_length=24):
     p_amplitude = []
     p_phase = []
 
-    for data_A, data_B in data:
-        amplitude_p_value, phase_p_value = cosinor_analysis(
-            groups[0], numpy.array([data_A]),
-            groups[1], numpy.array([data_B]),
+    for data_A, data_B in blocks(data, BATCH_SIZE):
+        amplitude_p_values, phase_p_values = cosinor_analysis(
+            groups[0], data_A,
+            groups[1], data_B,
             timepoints_per_cycle=round(cycle_length / Δt),
         )
 
-        p_amplitude.append(amplitude_p_value)
-        p_phase.append(phase_p_value)
+        p_amplitude.extend(amplitude_p_values)
+        p_phase.extend(phase_p_values)
 
-    return p_amplitude, p_phase
+    return numpy.array(p_amplitude), numpy.array(p_phase)
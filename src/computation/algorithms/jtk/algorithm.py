@@ -1,40 +1,315 @@
+#### Associated literature: Michael E. Hughes, John B. Hogenesch, and Karl Kornacker. J Biol Rhythms. 25(5):372-80 (2010).
+#### Port of JTK_CYCLE v3.1 as packaged in MetaCycle
+
+import fcntl
+import os
 import numpy as np
 
+from functools import lru_cache
+from math import lgamma, log
 from pathlib import Path
+from sys import float_info
+from tempfile import gettempdir
 
-from rpy2.robjects import numpy2ri
-from rpy2.robjects.packages import STAP
-
-from utilities import enough_timepoints, remove_missing_values
+from scipy.special import ndtr
 
-numpy2ri.activate()
+from algorithms import blocks_with_data, operates_on_blocks, shares_block_data
 
 START_PERIOD = 20
 END_PERIOD = 28
 
+BATCH_SIZE = 1_000
+
+AMPLITUDE_FACTOR = np.sqrt(2)  # 1/median(abs(cosine)) used to calculate amplitudes
+PI_HAT = round(np.pi, 4)  # Replacement for π to ensure unique cosine values
+
+# Kept across warm invocations and shared by all worker processes, the least recently
+# computed distributions being removed beyond MAXIMUM_DISTRIBUTION_CACHE_SIZE bytes
+DISTRIBUTION_CACHE_DIRECTORY = Path(gettempdir()) / "jtk"
+MAXIMUM_DISTRIBUTION_CACHE_SIZE = 256 * 2**20
+
+# Distributions kept memory-mapped by each process
+MAXIMUM_NUMBER_OF_MAPPED_DISTRIBUTIONS = 128
 
-def jtk(data, sample_collection_times, compute_wave_properties=False):
-    with open(Path(__file__).parent / "algorithm.R") as algorithm:
-        JTK = STAP(algorithm.read(), "JTK")
 
-    JTK.initialize(sample_collection_times, minper=START_PERIOD, maxper=END_PERIOD)
+@operates_on_blocks
+@shares_block_data
+def jtk(data, sample_collection_times, compute_wave_properties=False, block_data=None):
+    timepoints, groups, group_sizes = np.unique(
+        sample_collection_times, return_inverse=True, return_counts=True
+    )
+
+    periods, interval = jtk_periods(timepoints)
+
+    # Switch to the normal approximation if the maximum possible negative log p-value is too large
+    exact = lgamma(group_sizes.sum() + 1) - sum(
+        lgamma(size + 1) for size in group_sizes
+    ) <= log(float_info.max) - 1
+
+    angles = reference_angles(len(timepoints), periods)
+    column_periods = np.repeat(periods, periods)
+    column_lags = np.concatenate([np.arange(period) for period in periods])
+
+    # Signs of the differences between the reference cosines for all pairs of samples
+    first, second = np.triu_indices(len(groups), k=1)
+    cos_values = np.cos(angles)
+    reference_signs = np.sign(
+        cos_values[:, groups[second]] - cos_values[:, groups[first]]
+    ).T.astype(np.float32)
 
     p, period, lag, amplitude = [], [], [], []
 
-    for y in data:
-        _, t = remove_missing_values(y, sample_collection_times)
+    for y, block_data in blocks_with_data(data, BATCH_SIZE, block_data):
+        # Kendall's S scores of all rows against all (period, lag) combinations, ignoring missing values
+        S = block_data.pairwise_signs @ reference_signs
+
+        adjusted_p_values = np.full(S.shape, np.nan)
 
-        if not enough_timepoints(t, (START_PERIOD + END_PERIOD) // 2):
-            for property in (p, period, lag, amplitude):
-                property.append(np.nan)
-        else:
-            wave_properties = JTK.jtkx(
-                y, compute_wave_properties=compute_wave_properties
+        for group in block_data.grouping:
+            if not group.has_enough_timepoints(
+                sample_collection_times, (START_PERIOD + END_PERIOD) // 2
+            ):
+                continue
+
+            sizes = np.bincount(groups[group.mask])
+            adjusted_p_values[group.indices] = np.minimum(
+                1, S.shape[1] * jtk_p_values(S[group.indices], sizes[sizes > 0], exact)
+            )  # Bonferroni adjustment
+
+        minimum_adjusted_p_values = np.min(adjusted_p_values, axis=1)
+        p.extend(minimum_adjusted_p_values)
+
+        if not compute_wave_properties:
+            continue
+
+        for i in range(len(y)):
+            if np.isnan(minimum_adjusted_p_values[i]):
+                for property in (period, lag, amplitude):
+                    property.append(np.nan)
+                continue
+
+            wave_properties = jtk_wave_properties(
+                y[i],
+                S[i],
+                adjusted_p_values[i] == minimum_adjusted_p_values[i],
+                groups,
+                angles,
+                column_periods,
+                column_lags,
             )
-            for property, value in zip((p, period, lag, amplitude), wave_properties):
+            for property, value in zip(
+                (period, lag, amplitude), (interval, interval, 1) * np.array(wave_properties)
+            ):
                 property.append(value)
 
     if compute_wave_properties:
-        return period, lag, amplitude
+        return np.array(period), np.array(lag), np.array(amplitude)
+    else:
+        return [np.array(p)]
+
+
+def jtk_periods(timepoints):
+    """Periods, in units of the sampling interval, searched by JTK, and the sampling interval"""
+
+    interval = timepoints[1] - timepoints[0]
+    end_time = len(timepoints) * interval
+
+    if end_time >= END_PERIOD and round(END_PERIOD / interval) >= 2:
+        last_period = round(END_PERIOD / interval)
+    elif END_PERIOD > end_time >= START_PERIOD and round(end_time / interval) >= 2:
+        last_period = round(end_time / interval)
+    else:
+        raise ValueError(
+            "The period range is out of the range that JTK can detect. "
+            f"It should be between {2 * interval} and {end_time}."
+        )
+
+    first_period = max(2, round(START_PERIOD / interval))
+
+    return np.arange(first_period, last_period + 1), interval
+
+
+def reference_angles(number_of_timepoints, periods):
+    """
+    Phases of the reference cosines at each timepoint, for all (period, lag) combinations
+
+    The lags of each period are its half-integer multiples of the sampling interval.
+    """
+
+    time_to_angle = 2 * PI_HAT / np.repeat(periods, periods)
+    lags = np.concatenate([np.arange(period) for period in periods])
+
+    return (np.arange(number_of_timepoints) + lags[:, np.newaxis] / 2) * time_to_angle[
+        :, np.newaxis
+    ]
+
+
+def jtk_p_values(S, group_sizes, exact):
+    """Two-tailed p-values of Kendall's S scores for data with the given replicate group sizes"""
+
+    number_of_values = group_sizes.sum()
+    maximum_score = (number_of_values**2 - np.sum(group_sizes**2)) // 2
+
+    jtk_statistic = (np.abs(S) + maximum_score) / 2
+
+    if exact:
+        p = 2 * jtk_distribution(tuple(sorted(group_sizes)))[
+            (2 * jtk_statistic).astype(int)
+        ]
+    else:
+        variance = (
+            number_of_values**2 * (2 * number_of_values + 3)
+            - np.sum(group_sizes**2 * (2 * group_sizes + 3))
+        ) / 72
+        p = 2 * ndtr((maximum_score / 2 - (jtk_statistic - 1 / 2)) / np.sqrt(variance))
+
+    p[S == 0] = 1
+
+    return p
+
+
+@lru_cache(maxsize=MAXIMUM_NUMBER_OF_MAPPED_DISTRIBUTIONS)
+def jtk_distribution(group_sizes):
+    """
+    Exact JTK distribution for the sorted replicate group sizes `group_sizes`
+
+    The distributions are saved in the cache directory and memory-mapped read-only,
+    so that the worker processes share them; a lock for each of them makes sure that
+    only one of the workers computes it, while the others compute different ones. The
+    file names are the run-length encoded group sizes.
+    """
+
+    sizes, counts = np.unique(group_sizes, return_counts=True)
+
+    DISTRIBUTION_CACHE_DIRECTORY.mkdir(parents=True, exist_ok=True)
+    path = DISTRIBUTION_CACHE_DIRECTORY / (
+        "-".join(f"{size}x{count}" for size, count in zip(sizes, counts)) + ".npy"
+    )
+
+    if not path.exists():
+        with open(path.with_suffix(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if not path.exists():
+                temporary_path = path.with_suffix(f".{os.getpid()}.tmp")
+                with open(temporary_path, "wb") as file:
+                    np.save(file, compute_jtk_distribution(group_sizes))
+                os.replace(temporary_path, path)
+
+                prune_distribution_cache(keep=path)
+
+    return np.load(path, mmap_mode="r")
+
+
+def prune_distribution_cache(keep):
+    """
+    Remove the least recently computed distributions of the cache directory, except
+    `keep`, until their total size is at most MAXIMUM_DISTRIBUTION_CACHE_SIZE
+
+    The processes which have a removed distribution memory-mapped keep reading it.
+    """
+
+    distributions = []
+    for path in DISTRIBUTION_CACHE_DIRECTORY.glob("*.npy"):
+        try:
+            distributions.append((path.stat(), path))
+        except FileNotFoundError:
+            pass
+
+    total_size = sum(status.st_size for status, _ in distributions)
+
+    for status, path in sorted(distributions, key=lambda item: item[0].st_mtime):
+        if total_size <= MAXIMUM_DISTRIBUTION_CACHE_SIZE:
+            break
+
+        if path != keep:
+            path.unlink(missing_ok=True)
+            total_size -= status.st_size
+
+
+def compute_jtk_distribution(group_sizes):
+    """
+    Upper-tail p-values of all integer and half-integer values of the JTK statistic
+
+    The exact null distribution is computed with the Harding algorithm
+    (http://www.jstor.org/pss/2347656) in integer arithmetic.
+    """
+
+    number_of_values = sum(group_sizes)
+    maximum_score = (number_of_values**2 - sum(size**2 for size in group_sizes)) // 2
+    mode = maximum_score // 2
+
+    # Lower half cumulative frequency distribution
+    frequencies = np.ones(mode + 1, dtype=object)
+
+    sizes = sorted(group_sizes)
+    for i, m in enumerate(sizes[:-1]):
+        n = sum(sizes[i + 1 :])
+
+        for t in range(n + 1, min(m + n, mode) + 1):
+            frequencies[t:] = frequencies[t:] - frequencies[:-t]
+
+        for s in range(1, min(m, mode) + 1):
+            for offset in range(s):
+                frequencies[offset::s] = np.cumsum(frequencies[offset::s])
+
+    # Append the symmetric upper half cumulative distribution
+    if maximum_score % 2:
+        upper_half = 2 * frequencies[mode] - np.append(frequencies[::-1], 0)[1:]
     else:
-        return [p]
+        upper_half = (
+            frequencies[mode] + frequencies[mode - 1] - np.append(frequencies[-2::-1], 0)[1:]
+        )
+
+    # Upper-tail cumulative frequencies for all integer values of the JTK statistic
+    upper_tail = np.concatenate((frequencies, upper_half))[::-1]
+
+    # Twice the cumulative frequencies, interpolated for the half-integer values
+    cumulative_frequencies = np.empty(2 * maximum_score + 1, dtype=object)
+    cumulative_frequencies[::2] = 2 * upper_tail
+    cumulative_frequencies[1::2] = upper_tail[:-1] + upper_tail[1:]
+
+    return (cumulative_frequencies / (2 * upper_tail[0])).astype(float)
+
+
+def jtk_wave_properties(y, S, optimal, groups, angles, column_periods, column_lags):
+    """
+    Period and lag, in units of the sampling interval, and amplitude of the reference
+    waveform with the largest amplitude among those with the optimal p-value
+    """
+
+    best_period, best_lag, maximum_amplitude = 0, 0, 0
+
+    for period in np.unique(column_periods[optimal]):
+        columns = np.flatnonzero(optimal & (column_periods == period))
+
+        # Values over all full cycles; the first timepoint only if there are none
+        number_of_timepoints = max(1, (groups.max() + 1) // period * period)
+        in_full_cycles = (groups < number_of_timepoints) & np.isfinite(y)
+
+        w = y[in_full_cycles]
+        w = (w - hodges_lehmann(w)) * AMPLITUDE_FACTOR
+
+        s = np.where(S[columns] < 0, -1, 1)
+        amplitudes = hodges_lehmann(
+            s[:, np.newaxis]
+            * w
+            * np.sign(np.cos(angles[np.ix_(columns, groups[in_full_cycles])]))
+        )
+
+        best = np.argmax(amplitudes)
+        if amplitudes[best] > maximum_amplitude:
+            best_period = period
+            best_lag = (
+                period + (1 - s[best]) * period / 4 - column_lags[columns[best]] / 2
+            ) % period
+            maximum_amplitude = amplitudes[best]
+
+    return best_period, best_lag, max(0, maximum_amplitude)
+
+
+def hodges_lehmann(z):
+    """Hodges-Lehmann estimators of the medians along the last axis of `z`"""
+
+    first, second = np.tril_indices(z.shape[-1])
+    return np.median(z[..., first] + z[..., second], axis=-1) / 2
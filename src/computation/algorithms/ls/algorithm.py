@@ -1,55 +1,128 @@
 import numpy as np
 from numpy import exp, sin, cos, arctan2
 
+from algorithms import blocks, operates_on_blocks
+
 MINIMUM_PERIOD = 20
 MAXIMUM_PERIOD = 28
 
-
-def remove_missing_values(y, sample_collection_times):
-    indices_of_finite_values_of_y = np.isfinite(y)
-    return (
-        y[indices_of_finite_values_of_y],
-        sample_collection_times[indices_of_finite_values_of_y],
-    )
+BATCH_SIZE = 1_000
 
 
+@operates_on_blocks
 def ls(data, sample_collection_times):
     test_frequencies = np.linspace(
         1 / MAXIMUM_PERIOD, 1 / MINIMUM_PERIOD, 4 * sample_collection_times.size
     )
 
     p = []
-    for y in data:
-        y, t = remove_missing_values(y, sample_collection_times)
 
-        if np.var(y) == 0 or t.size == 0:
-            p.append(1.0)  # check if this makes sense
-            continue
+    for y in blocks(data, BATCH_SIZE):
+        p.extend(lomb_scargle(y, sample_collection_times, test_frequencies))
+
+    return [np.array(p)]
+
+
+def lomb_scargle(y, t, test_frequencies):
+    """
+    False alarm probabilities of the highest peaks of the periodograms of the rows of `y`
+
+    Complete rows share the offsets τ, and hence the basis, of their periodograms;
+    the periodograms of the other rows are computed from the masked sums.
+    """
+
+    finite = np.isfinite(y)
+    complete = np.all(finite, axis=1)
+    number_of_values = np.sum(finite, axis=1)
+
+    ω = 2 * np.pi * test_frequencies
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = np.nanvar(y, ddof=1, axis=1)
+        r = np.where(finite, y - np.nanmean(y, axis=1, keepdims=True), 0)
+
+        spectral_power_density = np.empty((len(y), ω.size))
+        spectral_power_density[complete] = periodogram_of_complete_rows(r[complete], t, ω)
+        spectral_power_density[~complete] = periodogram(r[~complete], finite[~complete], t, ω)
+
+        spectral_power_density /= 2 * variance[:, np.newaxis]
+
+    number_of_independent_frequencies = np.maximum(
+        1, (-6.362 + 1.193 * number_of_values + 0.00098 * number_of_values**2).astype(int)
+    )
+
+    peak_spectral_power_density = spectral_power_density[
+        np.arange(len(y)), np.argmax(spectral_power_density, axis=1)
+    ]
+    probabilities = (
+        1 - (1 - exp(-peak_spectral_power_density)) ** number_of_independent_frequencies
+    )
+
+    probabilities[(number_of_values == 0) | (np.nanvar(y, axis=1) == 0)] = 1.0  # check if this makes sense
+
+    return probabilities
+
+
+def periodogram_of_complete_rows(r, t, ω):
+    """
+    Unnormalized periodograms of the rows of `r`, all with values at every time of `t`
+    """
+
+    ωt = ω[:, np.newaxis] * t
+    ωτ = arctan2(np.sum(sin(2 * ωt), axis=1), np.sum(cos(2 * ωt), axis=1)) / 2
+
+    Δ = ωt - ωτ[:, np.newaxis]
+    cos_Δ, sin_Δ = cos(Δ), sin(Δ)
+
+    return spectral_power(
+        r @ cos_Δ.T, np.sum(cos_Δ**2, axis=1), t.size
+    ) + spectral_power(r @ sin_Δ.T, np.sum(sin_Δ**2, axis=1), t.size)
+
+
+def periodogram(r, finite, t, ω):
+    """
+    Unnormalized periodograms of the rows of `r`, with zeros in place of missing values
+
+    The frequency × time basis is computed once for the sampling times `t`;
+    the sums over the finite values of each row, including those giving the
+    offsets τ, are then obtained by matrix products with the zero-filled data
+    and the mask of finite values, using
+
+        cos(ω(t - τ)) = cos(ωt)cos(ωτ) + sin(ωt)sin(ωτ)
+    """
+
+    number_of_values = np.sum(finite, axis=1, keepdims=True)
+
+    ωt = ω[:, np.newaxis] * t
+    cos_ωt, sin_ωt = cos(ωt), sin(ωt)
+
+    weights = finite.astype(float)
+    sum_of_cos_2ωt = weights @ cos(2 * ωt).T
+    sum_of_sin_2ωt = weights @ sin(2 * ωt).T
 
-        number_of_independent_frequencies = horne_baliunas(t.size)
+    ωτ = arctan2(sum_of_sin_2ωt, sum_of_cos_2ωt) / 2
+    cos_ωτ, sin_ωτ = cos(ωτ), sin(ωτ)
 
-        r = y - np.mean(y)
+    sum_of_r_cos_ωt = r @ cos_ωt.T
+    sum_of_r_sin_ωt = r @ sin_ωt.T
 
-        spectral_power_density = np.empty(test_frequencies.size)
-        for i, test_frequency in enumerate(test_frequencies):
-            ω = 2 * np.pi * test_frequency
-            τ = np.arctan2(np.sum(sin(2 * ω * t)), np.sum(cos(2 * ω * t))) / (2 * ω)
+    sum_of_r_cos_Δ = sum_of_r_cos_ωt * cos_ωτ + sum_of_r_sin_ωt * sin_ωτ
+    sum_of_r_sin_Δ = sum_of_r_sin_ωt * cos_ωτ - sum_of_r_cos_ωt * sin_ωτ
 
-            Δ = ω * (t - τ)
-            spectral_power_density[i] = (
-                np.sum(r * cos(Δ)) ** 2 / np.sum(cos(Δ) ** 2)
-            ) + (np.sum(r * sin(Δ)) ** 2 / np.sum(sin(Δ) ** 2))
+    # τ is chosen so that the sum of sin(2Δ) vanishes
+    sum_of_cos_2Δ = np.hypot(sum_of_cos_2ωt, sum_of_sin_2ωt)
 
-        spectral_power_density /= 2 * np.var(y, ddof=1)
+    return spectral_power(
+        sum_of_r_cos_Δ, (number_of_values + sum_of_cos_2Δ) / 2, number_of_values
+    ) + spectral_power(sum_of_r_sin_Δ, (number_of_values - sum_of_cos_2Δ) / 2, number_of_values)
 
-        peak_index = np.argmax(spectral_power_density)
-        probabilities = (
-            1 - (1 - exp(-spectral_power_density)) ** number_of_independent_frequencies
-        )
-        p.append(probabilities[peak_index])
 
-    return [p]
+def spectral_power(sum_of_r_basis, sum_of_basis_squared, number_of_values):
+    # Terms whose basis vanishes at every sample collection time, as when all values
+    # are collected at the same time, carry no power but lose all precision
+    tolerance = np.sqrt(np.finfo(float).eps) * number_of_values
 
+    with np.errstate(divide="ignore"):
+        weights = np.where(sum_of_basis_squared > tolerance, 1 / sum_of_basis_squared, 0)
 
-def horne_baliunas(n):
-    return max(1, int(-6.362 + 1.193 * n + 0.00098 * n ** 2))
+    return sum_of_r_basis**2 * weights
@@ -1,31 +1,83 @@
 import numpy as np
-from scipy.stats import f_oneway
+from scipy.stats import f
 
-from collections import defaultdict
+from algorithms import blocks_with_data, operates_on_blocks, shares_block_data
 
+BATCH_SIZE = 1_000
 
-def remove_missing_values(y, sample_collection_times):
-    indices_of_finite_values_of_y = np.isfinite(y)
-    return (
-        y[indices_of_finite_values_of_y],
-        sample_collection_times[indices_of_finite_values_of_y],
+
+@operates_on_blocks
+@shares_block_data
+def one_way_anova(data, sample_collection_times, cycle_length=24, block_data=None):
+    p = []
+
+    for y, block_data in blocks_with_data(data, BATCH_SIZE, block_data):
+        F = np.full(len(y), np.nan)
+        degrees_of_freedom = np.zeros((2, len(y)))
+
+        for group in block_data.grouping:
+            F[group.indices], (
+                degrees_of_freedom[0, group.indices],
+                degrees_of_freedom[1, group.indices],
+            ) = f_oneway(
+                y[np.ix_(group.indices, group.mask)],
+                sample_collection_times[group.mask] % cycle_length,
+            )
+
+        p.extend(f.sf(F, *degrees_of_freedom))
+
+    return [np.array(p)]
+
+
+def f_oneway(y, groups):
+    """
+    One-way ANOVA of every row of `y` with the columns grouped by `groups`
+
+    Same as scipy.stats.f_oneway, with the group sums of all rows computed
+    by segment reductions over the columns sorted by group. Returns the F
+    statistics and their degrees of freedom.
+    """
+
+    labels, starts, sizes = np.unique(
+        np.sort(groups), return_index=True, return_counts=True
     )
 
+    number_of_groups = len(labels)
+    number_of_values = len(groups)
 
-def one_way_anova(data, sample_collection_times, cycle_length=24):
-    p = []
-    for y in data:
-        y, t = remove_missing_values(y, sample_collection_times)
+    degrees_of_freedom = (
+        number_of_groups - 1,
+        number_of_values - number_of_groups,
+    )
+
+    if number_of_groups < 2 or np.all(sizes == 1):
+        return np.nan, degrees_of_freedom
+
+    y = y[:, np.argsort(groups, kind="stable")]
 
-        groups = defaultdict(list)
-        for t_mod_cycle_length, value in zip(t % cycle_length, y):
-            groups[t_mod_cycle_length].append(value)
+    # Centering all data around zero improves numerical stability
+    y = y - y.mean(axis=1, keepdims=True)
 
-        groups = groups.values()
+    normalized_sum_of_squares = np.sum(y, axis=1) ** 2 / number_of_values
+    total_sum_of_squares = np.sum(y * y, axis=1) - normalized_sum_of_squares
 
-        if all(len(group) == 1 for group in groups) or len(groups) < 2:
-            p.append(np.nan)
-        else:
-            p.append(f_oneway(*groups)[1])
+    group_sums = np.add.reduceat(y, starts, axis=1)
+    between_groups_sum_of_squares = (
+        np.sum(group_sums**2 / sizes, axis=1) - normalized_sum_of_squares
+    )
+    within_groups_sum_of_squares = total_sum_of_squares - between_groups_sum_of_squares
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        F = (between_groups_sum_of_squares / degrees_of_freedom[0]) / (
+            within_groups_sum_of_squares / degrees_of_freedom[1]
+        )
+
+    # Constant groups give infinite F, unless all groups share the same constant
+    constant_groups = np.all(
+        np.maximum.reduceat(y, starts, axis=1) == np.minimum.reduceat(y, starts, axis=1),
+        axis=1,
+    )
+    F[constant_groups] = np.inf
+    F[np.all(y == y[:, :1], axis=1)] = np.nan
 
-    return [p]
+    return F, degrees_of_freedom
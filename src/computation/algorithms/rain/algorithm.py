@@ -1,56 +1,261 @@
-import numpy as np
-import rpy2.robjects as R
+#### Associated literature: Paul F. Thaben and Pål O. Westermark. J Biol Rhythms. 29(6):391-400 (2014).
+#### Port of the 'independent' method of RAIN
 
-from itertools import islice
-from pathlib import Path
+import numpy as np
 
-from rpy2.robjects import numpy2ri
-from rpy2.robjects.packages import STAP
+from functools import lru_cache
+from math import ceil, floor
 
+from algorithms import blocks_with_data, operates_on_blocks, shares_block_data
 from utilities import find_indices_with_enough_timepoints
 
-numpy2ri.activate()
-
-R.r.library("multtest")
-R.r.library("gmp")
-
-BATCH_SIZE = 200
+BATCH_SIZE = 1_000
 
+PEAK_BORDER = (0.3, 0.7)
 
-def rain(data, sample_collection_times, cycle_length=24):
-    with open(Path(__file__).parent / "algorithm.R") as algorithm:
-        RAIN = STAP(algorithm.read(), "RAIN")
 
+@operates_on_blocks
+@shares_block_data
+def rain(data, sample_collection_times, cycle_length=24, block_data=None):
     timepoints = sorted(set(sample_collection_times))
     Δt = float(timepoints[1] - timepoints[0])
 
     number_of_timepoints = len(timepoints)
     sample_collection_times_indices = np.round(sample_collection_times / Δt).astype(int)
 
-    measure_sequence = np.zeros(number_of_timepoints)
-    for sample_collection_times_index in sample_collection_times_indices:
-        measure_sequence[sample_collection_times_index] += 1
+    periods = range(floor(cycle_length / Δt), ceil(cycle_length / Δt) + 1)
+
+    tests, expected_signs = umbrella_tests(
+        sample_collection_times_indices, number_of_timepoints, periods
+    )
+
+    # Indicator of the timepoint of each sample
+    measurements = np.zeros((len(sample_collection_times), number_of_timepoints))
+    measurements[np.arange(len(sample_collection_times)), sample_collection_times_indices] = 1
 
     p = []
-    while batch := list(islice(data, BATCH_SIZE)):
-        y = np.array(batch)
 
+    for y, block_data in blocks_with_data(data, BATCH_SIZE, block_data):
         indices_with_enough_timepoints = find_indices_with_enough_timepoints(
-            y, sample_collection_times, cycle_length
+            block_data.grouping, sample_collection_times, cycle_length
         )
 
         P = np.full(len(y), np.nan)
-        P.put(
-            indices_with_enough_timepoints,
-            RAIN.rain(
-                y[indices_with_enough_timepoints].T,
-                period=cycle_length,
-                deltat=Δt,
-                measure_sequence=measure_sequence,
-                na_rm=bool(np.isnan(y).any()),
-            ).rx2("pVal"),
-        )
+
+        if len(indices_with_enough_timepoints) > 0:
+            signs = block_data.pairwise_signs[indices_with_enough_timepoints]
+            y = y[indices_with_enough_timepoints]
+
+            # Umbrella statistics of all rows for all tests: the numbers of pairs of
+            # samples whose order agrees with the one expected by the test
+            scores = np.rint(
+                (signs @ expected_signs.T + np.abs(signs) @ np.abs(expected_signs).T) / 2
+            ).astype(int)
+
+            # Rows with the same number of values at each timepoint share the null distributions
+            measure_sequences, inverse = np.unique(
+                np.isfinite(y) @ measurements, axis=0, return_inverse=True
+            )
+            inverse = inverse.reshape(-1)
+
+            p_values = np.empty(scores.shape)
+            for i, measure_sequence in enumerate(measure_sequences):
+                rows = np.flatnonzero(inverse == i)
+
+                phase_sizes = {
+                    period: np.bincount(
+                        np.arange(number_of_timepoints) % period, weights=measure_sequence
+                    )
+                    .astype(int)
+                    .tolist()
+                    for period in periods
+                }
+
+                # As in RAIN, tests with the same code use the distribution of the first of them
+                representatives = {}
+
+                # p-values of all tests for all scores up to the largest, zero scoring a p-value of 1
+                maximum_score = scores[rows].max()
+                table = np.ones((len(tests), maximum_score + 1))
+                for j, (period, phase, peak) in enumerate(tests):
+                    group_sizes = tuple(
+                        phase_sizes[period][(phase + k) % period] for k in range(period + 1)
+                    )
+                    distribution = umbrella_distribution(
+                        *representatives.setdefault(
+                            umbrella_code(group_sizes, peak), (group_sizes, peak)
+                        )
+                    )
+                    table[j, 1 : len(distribution) + 1] = distribution[:maximum_score]
+
+                p_values[rows] = table[np.arange(len(tests)), scores[rows]]
+
+            P[indices_with_enough_timepoints] = adaptive_benjamini_hochberg(p_values)
 
         p.extend(P)
 
-    return [p]
+    return [np.array(p)]
+
+
+def umbrella_tests(timepoint_indices, number_of_timepoints, periods):
+    """
+    Periods, phases and peak shapes of all umbrella tests, with the expected signs of
+    the differences between the values of all pairs of samples
+
+    For each period, the timepoints are grouped by phase. The groups, from the peak
+    through a full period back to the peak, form a falling then a rising slope.
+    """
+
+    first, second = np.triu_indices(len(timepoint_indices), k=1)
+
+    tests, expected_signs = [], []
+    for period in periods:
+        peaks = [
+            peak
+            for peak in range(
+                ceil((1 - PEAK_BORDER[0]) * period), floor((1 - PEAK_BORDER[1]) * period) - 1, -1
+            )
+            if 0 < peak < period
+        ]
+
+        phases = timepoint_indices % period
+        for phase in range(period):
+            groups = (phase + np.arange(period + 1)) % period
+
+            for peak in peaks:
+                comparisons = np.zeros((period, period))
+                for slope, sign in [(groups[: peak + 1], 1), (groups[peak:], -1)]:
+                    x, y = np.triu_indices(len(slope), k=1)
+                    np.add.at(comparisons, (slope[x], slope[y]), sign)
+                    np.add.at(comparisons, (slope[y], slope[x]), -sign)
+
+                tests.append((period, phase, peak))
+                expected_signs.append(np.sign(comparisons)[phases[second], phases[first]])
+
+    return tests, np.array(expected_signs, dtype=np.float32)
+
+
+def umbrella_code(group_sizes, peak):
+    """
+    Code of the umbrella test with the given group sizes and peak, as generated by
+    RAIN: the sizes of the two extremes and the sizes of the groups on either slope
+    between them, up to order
+    """
+
+    return tuple(sorted([group_sizes[0], group_sizes[peak]])), tuple(
+        sorted([tuple(sorted(group_sizes[1:peak])), tuple(sorted(group_sizes[peak + 1 : -1]))])
+    )
+
+
+@lru_cache(maxsize=16_384)
+def umbrella_distribution(group_sizes, peak):
+    """
+    Upper-tail p-values of the umbrella statistic, shifted by one as in RAIN
+
+    As in RAIN, the generating function of the distribution is the product of those
+    of the statistics of the two slopes and of the comparisons between the first group,
+    which closes the cycle, and the falling slope; its lower half is completed by
+    symmetry as RAIN does it.
+    """
+
+    special, *sizes = group_sizes
+    number_of_groups = len(sizes)
+
+    if peak == 1:
+        special = 0
+
+    inflections = [peak] if 1 < peak < number_of_groups else []
+    boundaries = [1, *inflections, number_of_groups]
+
+    frequencies = np.ones(1)
+    for start, end in zip(boundaries, boundaries[1:]):
+        frequencies = np.convolve(
+            frequencies, jonckheere_distribution(tuple(sorted(sizes[start - 1 : end])))
+        )
+
+    if special:
+        frequencies = np.convolve(
+            frequencies, mann_whitney_distribution(special, sum(sizes[: boundaries[1] - 1]))
+        )
+
+    maximum_score = len(frequencies) - 1
+    if maximum_score == 0:
+        return np.ones(1)
+
+    frequencies = frequencies[: (maximum_score + 1) // 2]
+
+    if maximum_score % 2 and len(frequencies) > 1:
+        frequencies = np.concatenate((frequencies, frequencies[-2::-1]))
+    else:
+        frequencies = np.concatenate((frequencies, frequencies[::-1]))
+
+    cumulative_frequencies = np.cumsum(frequencies)
+
+    return cumulative_frequencies[::-1] / cumulative_frequencies[-1]
+
+
+@lru_cache(maxsize=1_024)
+def jonckheere_distribution(group_sizes):
+    """Null distribution of the Jonckheere-Terpstra statistic of groups of the given sizes"""
+
+    frequencies = np.ones(1)
+    for i, size in enumerate(group_sizes):
+        frequencies = np.convolve(
+            frequencies, mann_whitney_distribution(sum(group_sizes[:i]), size)
+        )
+
+    return frequencies
+
+
+@lru_cache(maxsize=1_024)
+def mann_whitney_distribution(m, n):
+    """
+    Null distribution of the Mann-Whitney statistic of groups of sizes `m` and `n`
+
+    The frequencies, the coefficients of the Gaussian binomial coefficient (m + n choose n),
+    are computed in integer arithmetic.
+    """
+
+    frequencies = np.zeros(m * n + 1, dtype=object)
+    frequencies[0] = 1
+
+    for k in range(1, n + 1):
+        # Multiply by 1 - q^(m + k) and divide by 1 - q^k
+        if m + k < len(frequencies):
+            frequencies[m + k :] = frequencies[m + k :] - frequencies[: -(m + k)]
+        if k < len(frequencies):
+            for offset in range(k):
+                frequencies[offset::k] = np.cumsum(frequencies[offset::k])
+
+    return (frequencies / frequencies.sum()).astype(float)
+
+
+def adaptive_benjamini_hochberg(p):
+    """
+    Adjusted p-value of the smallest p-value of each row of `p`, with the adaptive
+    Benjamini-Hochberg procedure as in multtest's mt.rawp2adjp
+    """
+
+    m = p.shape[1]
+    i = np.arange(1, m + 1)
+
+    p = np.sort(p, axis=1)
+
+    # Estimate of the number of true null hypotheses
+    with np.errstate(divide="ignore", invalid="ignore"):
+        h0 = (m + 1 - i) / (1 - p)
+        increasing = np.diff(h0, axis=1) > 0
+
+    found = np.any(increasing, axis=1)
+    h0 = np.ceil(np.minimum(h0[np.arange(len(p)), np.argmax(increasing, axis=1)], m))
+
+    adjusted = np.minimum(
+        p[:, -1],
+        np.min(np.minimum(h0[:, np.newaxis] / i[:-1] * p[:, :-1], 1), axis=1, initial=1),
+    )
+
+    # Without an estimate all the adjusted p-values are the largest p-value
+    adjusted[~found] = p[~found, -1]
+    adjusted[p[:, 0] == p[:, -1]] = 1
+
+    return adjusted
@@ -1,7 +1,11 @@
 import numpy
 import pandas
+import scipy.stats
 
-import statsmodels.api as sm
+from algorithms import blocks, operates_on_blocks
+from utilities import group_by_missing_values
+
+BATCH_SIZE = 1_000
 
 
 def perform_two_way_anova(groups_A, data_A, groups_B, data_B):
@@ -52,25 +56,87 @@ def perform_two_way_anova(groups_A, data_A, groups_B, data_B):
 
     combined_datasets = numpy.concatenate((data_A, data_B), axis=1)
 
-    # Fit models and compute p-values for each gene
-    interaction_p_values = numpy.empty(combined_datasets.shape[0])
-    main_effect_p_values = numpy.empty(combined_datasets.shape[0])
-    for i in range(combined_datasets.shape[0]):
-        if numpy.isnan(combined_datasets[i]).all():
-            interaction_p_values[i] = float("NaN")
-            main_effect_p_values[i] = float("NaN")
+    # Fit models and compute F statistics for all genes sharing the same missing values at once
+    num_features = combined_datasets.shape[0]
+    interaction_F, main_effect_F = numpy.full((2, num_features), float("NaN"))
+    interaction_df_num, main_effect_df_num, df_denom = numpy.zeros((3, num_features), dtype=int)
+
+    for group in group_by_missing_values(combined_datasets):
+        design = full_model.T[group.mask]
+        y = combined_datasets[numpy.ix_(group.indices, group.mask)]
+
+        # Least squares fit of the full model, as statsmodels' OLS does it
+        pseudo_inverse, rank = pseudo_inverse_and_rank(design)
+        normalized_covariance = pseudo_inverse @ pseudo_inverse.T
+        degrees_of_freedom = group.mask.sum() - rank
+
+        if degrees_of_freedom < 1:
             continue
-        full_fit = sm.OLS(combined_datasets[i], full_model.T, missing='drop').fit()
 
-        restricted_test = full_fit.f_test(interaction_restrictions)
-        interaction_p_values[i] = restricted_test.pvalue
+        params = y @ pseudo_inverse.T
+        scale = ((y - params @ design.T)**2).sum(axis=1) / degrees_of_freedom
+
+        interaction_F[group.indices], interaction_df_num[group.indices] = f_statistic(
+            interaction_restrictions, params, normalized_covariance, scale
+        )
+        main_effect_F[group.indices], main_effect_df_num[group.indices] = f_statistic(
+            main_effect_restriction, params, normalized_covariance, scale
+        )
+        df_denom[group.indices] = degrees_of_freedom
+
+    interaction_p_values = scipy.stats.f.sf(interaction_F, interaction_df_num, df_denom)
+    main_effect_p_values = scipy.stats.f.sf(main_effect_F, main_effect_df_num, df_denom)
+
+    return interaction_p_values, main_effect_p_values
+
+
+def f_statistic(restrictions, params, normalized_covariance, scale):
+    '''
+    F statistics of the linear hypothesis `restrictions` @ params = 0 for fits sharing a design
+
+    The restricted minus unrestricted sum of squared residuals of each gene is the quadratic
+    form of `restrictions` @ params in the inverse covariance of the restrictions, which only
+    depends on the design.
+
+    Returns the F statistics of size (num_features) and their numerator degrees of freedom
+    '''
+
+    restrictions_covariance = restrictions @ normalized_covariance @ restrictions.T
+    inverse_restrictions_covariance, number_of_restrictions = pseudo_inverse_and_rank(
+        restrictions_covariance
+    )
+
+    restricted_params = params @ restrictions.T
+    sum_of_squares = numpy.sum(
+        (restricted_params @ inverse_restrictions_covariance) * restricted_params, axis=1
+    )
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        F = sum_of_squares / scale / number_of_restrictions
+
+    # A perfect fit leaves no variance to test the restrictions against
+    F[scale == 0] = float("NaN")
+
+    return F, number_of_restrictions
+
+
+def pseudo_inverse_and_rank(matrix):
+    '''
+    Same as numpy.linalg.pinv and numpy.linalg.matrix_rank, from a single SVD
+    '''
+
+    u, s, vt = numpy.linalg.svd(matrix, full_matrices=False)
+
+    largest_singular_value = s.max(initial=0)
+    rank = numpy.sum(s > largest_singular_value * max(matrix.shape) * numpy.finfo(float).eps)
 
-        main_effect_test = full_fit.f_test(main_effect_restriction)
-        main_effect_p_values[i] = main_effect_test.pvalue
+    significant = s > 1e-15 * largest_singular_value
+    pseudo_inverse = (vt[significant].T / s[significant]) @ u[:, significant].T
 
-    return interaction_p_values[0], main_effect_p_values[0]
+    return pseudo_inverse, rank
 
 
+@operates_on_blocks
 def two_way_anova(data, sample_collection_times, cycle_length=24):
 
     groups = []
@@ -84,12 +150,12 @@ def two_way_anova(data, sample_collection_times, cycle_length=24):
     p_interaction = []
     p_main_effect = []
 
-    for data_A, data_B in data:
-        interaction_p_value, main_effect_p_value = perform_two_way_anova(
-            groups[0], numpy.array([data_A]), groups[1], numpy.array([data_B])
+    for data_A, data_B in blocks(data, BATCH_SIZE):
+        interaction_p_values, main_effect_p_values = perform_two_way_anova(
+            groups[0], data_A, groups[1], data_B
         )
 
-        p_interaction.append(interaction_p_value)
-        p_main_effect.append(main_effect_p_value)
+        p_interaction.extend(interaction_p_values)
+        p_main_effect.extend(main_effect_p_values)
 
-    return p_interaction, p_main_effect
+    return numpy.array(p_interaction), numpy.array(p_main_effect)
@@ -1,12 +1,18 @@
 import numpy as np
 
-from algorithms.upside.upside import main
-from itertools import chain, islice, permutations
+from algorithms import blocks, operates_on_blocks
+from algorithms.upside.upside import N_PERMS, N_PERMS_SEQUENTIAL, main, permutation_indexes
+from itertools import chain
 
 BATCH_SIZE = 200
 
 
-def upside(data, sample_collection_times, cycle_length=24):
+@operates_on_blocks
+def upside(data, sample_collection_times, cycle_length=24, sequential=False):
+    """
+    p-values of dampening from A to B and from B to A, followed, if `sequential`, by
+    the numbers of permutations taken for them
+    """
 
     groups = []
 
@@ -16,28 +22,43 @@ def upside(data, sample_collection_times, cycle_length=24):
 
         groups.append(np.round((collection_times % cycle_length) / Δt).astype(int))
 
+    timepoints_per_cycle = round(cycle_length / Δt)
+
+    # Drawn for each call, and shared by its batches
+    perm_indexes = permutation_indexes(
+        *groups, timepoints_per_cycle, N_PERMS_SEQUENTIAL if sequential else N_PERMS
+    )
+
     p = [[], []]
+    number_of_permutations = [[], []]
+
+    for batch in blocks(data, BATCH_SIZE):
+        # Both directions, A to B and B to A, in one pass over the permutations
+        P, N = main(
+            *chain(*zip(groups, batch)),
+            timepoints_per_cycle=timepoints_per_cycle,
+            sequential=sequential,
+            perm_indexes=perm_indexes,
+        )
+        for i in range(2):
+            p[i].extend(P[i])
+            number_of_permutations[i].extend(N[i])
 
-    while batch := list(islice(data, BATCH_SIZE)):
-        for i, groups_and_data in enumerate(
-            permutations(zip(groups, map(np.array, zip(*batch))))
-        ):
-            p[i].extend(
-                main(
-                    *chain(*groups_and_data),
-                    timepoints_per_cycle=round(cycle_length / Δt),
-                )
-            )
+    if sequential:
+        return [np.array(results) for results in p + number_of_permutations]
 
-    return p
+    return [np.array(results) for results in p]
 
 
 if __name__ == "__main__":
-    a = [(np.array([1, 2, 3, 4, 5, 6]), np.array([4, 2, 1, 31, 12, 2]))] * 10
+    a = (
+        np.array([[1, 2, 3, 4, 5, 6]] * 10),
+        np.array([[4, 2, 1, 31, 12, 2]] * 10),
+    )
 
     sample_collection_times = [
         np.array([0.0, 6.0, 12.0, 18.0, 24.0, 30.0]),
         np.array([0.0, 6.0, 12.0, 18.0, 24.0, 30.0]),
     ]
 
-    print(upside((x for x in a), sample_collection_times))
+    print(upside(a, sample_collection_times))
@@ -15,8 +15,14 @@ import numpy
 
 # Number of permutations to take for permuted test statistics
 N_PERMS = 2_000
-# Number of permutations to compute at one go, reduce this number to reduce memory useage
-N_PERMS_PER_RUN = 20
+# Number of permuted values to compute at one go, reduce this number to reduce memory useage
+BLOCK_SIZE = 2_000_000
+
+# Sequential mode (Besag and Clifford, 1991): stop permuting a feature as soon as this many
+# of its permuted test statistics are at least its own test statistic
+N_EXCEEDANCES = 10
+# Maximum number of permutations for the features that do not stop early in sequential mode
+N_PERMS_SEQUENTIAL = 20_000
 
 def zero_nans(array):
     ''' Sets all nans in a numpy array to zero, works in-place
@@ -28,9 +34,9 @@ def zero_nans(array):
     nans = numpy.isnan(array)
     array[nans] = 0
 
-def main(timepoints_A, data_A, timepoints_B, data_B, timepoints_per_cycle, repeated_measures=False):
+def main(timepoints_A, data_A, timepoints_B, data_B, timepoints_per_cycle, repeated_measures=False, sequential=False, block_size=BLOCK_SIZE, perm_indexes=None):
     """
-    Compute the dampening p-values comparing A to B
+    Compute the dampening p-values comparing A to B and B to A
 
     `timepoints_A` is a list of integers indicating timepoint of each column of data_A
     `data_A` is a numpy array of shape (num_features, num_samples)
@@ -42,8 +48,19 @@ def main(timepoints_A, data_A, timepoints_B, data_B, timepoints_per_cycle, repea
     `repeated_measures` is whether the data was taken from individuals repeatedly. Leave as False if
             each datapoint is independent. If True, must position the individuals consistently,
             e.g. first individual always is first in each timepoint in its dataset
-
-    Returns a array of p-values of size (num_features).
+    `sequential` is whether to stop permuting each feature once N_EXCEEDANCES of its permuted
+            statistics are at least its statistic, up to N_PERMS_SEQUENTIAL permutations,
+            instead of always taking N_PERMS permutations
+    `block_size` is the maximum number of permuted values to compute at one go
+    `perm_indexes` are the permutations to take, as given by permutation_indexes, so that
+            the batches of features of an analysis share them; new ones are drawn if not given
+
+    Both directions use the same permutations: each one scrambles the replicates of A and B
+    within each timepoint, the replicates landing in A giving the permuted A and the others
+    the permuted B.
+
+    Returns arrays of shape (2, num_features) of the p-values of dampening from A to B and
+    from B to A and of the numbers of permutations taken.
     """
 
     assert data_A.shape[0] == data_B.shape[0]
@@ -54,85 +71,102 @@ def main(timepoints_A, data_A, timepoints_B, data_B, timepoints_per_cycle, repea
     data_B = data_B.astype(float)
 
     # First thing we do is to normalize the medians of the two datasets A and B
-    # otherwise a constant offset between the two makes a dramatic difference
+    # otherwise a constant offset between the two makes a dramatic difference.
+    # The statistic does not change when a feature is offset, so normalizing B to A
+    # serves both directions
     A_median = numpy.nanmedian(data_A, axis=1)
     B_median = numpy.nanmedian(data_B, axis=1)
     data_B += (A_median - B_median)[:, None]
 
     N_FEATURES = data_A.shape[0]
+    N_SAMPLES_A = data_A.shape[1]
+
+    max_num_perms = N_PERMS_SEQUENTIAL if sequential else N_PERMS
+    max_num_exceedances = N_EXCEEDANCES if sequential else numpy.inf
+
+    # Join the two datasets so we can index both
+    data_joined = numpy.concatenate((data_A, data_B), axis=1)
+
+    if perm_indexes is None:
+        perm_indexes = permutation_indexes(timepoints_A, timepoints_B, timepoints_per_cycle, max_num_perms, repeated_measures=repeated_measures)
+    assert len(perm_indexes) >= max_num_perms
+
+    # Columns of the joined dataset and timepoints of A and of B
+    directions = [(numpy.arange(N_SAMPLES_A), timepoints_A), (numpy.arange(N_SAMPLES_A, data_joined.shape[1]), timepoints_B)]
+
+    stat = numpy.array([upside_statistic(data_joined[:, columns], timepoints, timepoints_per_cycle, repeated_measures=repeated_measures)
+                            for columns, timepoints in directions])
+
+    # Features still being permuted, with their numbers of permuted statistics at least their statistic
+    active = [numpy.arange(N_FEATURES) for _ in directions]
+    num_exceedances = numpy.zeros((len(directions), N_FEATURES))
+    num_perms_taken = numpy.full((len(directions), N_FEATURES), max_num_perms)
 
-    stat = upside_statistic(data_A, timepoints_A, timepoints_per_cycle, repeated_measures=repeated_measures)
-    
     num_perms_done = 0
-    perm_stat = numpy.empty((N_PERMS, N_FEATURES))
-    while True:
-        if num_perms_done >= N_PERMS:
-            break
+    while any(rows.size > 0 for rows in active) and num_perms_done < max_num_perms:
+        num_active_values = sum(rows.size * columns.size for rows, (columns, _) in zip(active, directions))
+        num_perms = min(max_num_perms - num_perms_done, max(1, block_size // num_active_values))
+        perm_indexes_block = perm_indexes[num_perms_done : num_perms_done + num_perms]
+
+        for i, (columns, timepoints) in enumerate(directions):
+            rows = active[i]
+            if rows.size == 0:
+                continue
+
+            # Of shape (num_perms, num_active_features, num_samples)
+            perm_data = data_joined[rows[None, :, None], perm_indexes_block[:, None, columns]]
+
+            perm_stat = upside_statistic(perm_data, timepoints, timepoints_per_cycle, repeated_measures=repeated_measures)
 
-        num_perms = min(N_PERMS - num_perms_done, N_PERMS_PER_RUN)
-        perm_data = permute(timepoints_A, data_A, timepoints_B, data_B, timepoints_per_cycle, N = num_perms, repeated_measures=repeated_measures)
+            # Stop each feature at the permutation giving its last needed exceedance
+            cumulative_exceedances = num_exceedances[i, rows] + numpy.cumsum(perm_stat >= stat[i, rows], axis=0)
+            reached = cumulative_exceedances >= max_num_exceedances
+            stopped = numpy.any(reached, axis=0)
 
-        perm_stat[num_perms_done:num_perms_done+num_perms] = upside_statistic(perm_data, timepoints_A, timepoints_per_cycle, repeated_measures=repeated_measures)
+            num_perms_taken[i, rows[stopped]] = num_perms_done + numpy.argmax(reached[:, stopped], axis=0) + 1
+            num_exceedances[i, rows] = cumulative_exceedances[-1]
+            num_exceedances[i, rows[stopped]] = max_num_exceedances
+
+            active[i] = rows[~stopped]
 
         num_perms_done += num_perms
 
     # p-values of the (non-permuted) data
-    ps = (numpy.sum(perm_stat >= stat, axis=0) + 1)/ (perm_stat.shape[0]+1)
+    ps = numpy.where(
+        num_exceedances >= max_num_exceedances,
+        num_exceedances / num_perms_taken,
+        (num_exceedances + 1) / (num_perms_taken + 1),
+    )
 
-    return ps
+    return ps, num_perms_taken
 
-def permute(timepoints_A, data_A, timepoints_B, data_B, timepoints_per_cycle, N = 1, repeated_measures=False):
+def permutation_indexes(timepoints_A, timepoints_B, timepoints_per_cycle, N, repeated_measures=False):
     """
-    Given data of conditions A and B, return permutations scrambling data of A and B together
+    Indexes into the columns of the joined data of conditions A and B of permutations
+    scrambling the replicates of A and B together while preserving the timepoint that they occur at
     If `repeated_measures` then keep corresponding datapoints together as if from same sample.
         I.e. the first datapoint of each timepoint is from Individual 1, then we better not scramble
         those across individuals
 
+    `timepoints_A` and `timepoints_B` are the timepoints of the columns of A and B
     `N` is the number of permutations to create
-    Return value is of shape (N, shape of data_A)
+    Return value is of shape (N, num_samples_A + num_samples_B), newly drawn at each call
     """
 
-    N_SAMPLES_A = data_A.shape[1]
-    N_SAMPLES_b = data_B.shape[1]
-
-    # Make slices indicating the replicates that occur at each possible time
-    indexes_for_timepoint_A = [[i for i,t in enumerate(timepoints_A) if (t % timepoints_per_cycle) == j]
-                                for j in range(timepoints_per_cycle)]
-    # for B, we offset so that there's space for A's samples too
-    indexes_for_timepoint_B = [[i+N_SAMPLES_A for i,t in enumerate(timepoints_B) if (t % timepoints_per_cycle) == j]
-                                for j in range(timepoints_per_cycle)]
-    # Indexes by timepoints for joined datasets of both A and B
-    joined_indexes = [indexes_A + indexes_B for indexes_A, indexes_B in zip(indexes_for_timepoint_A, indexes_for_timepoint_B)]
-
-    num_reps_A = [len(indexes) for indexes in indexes_for_timepoint_A]
-
-    #time_starts_A = numpy.cumsum(num_reps_A) - num_reps_A[0]
-    #times_A = [slice(time_start, time_start + reps) for time_start, reps in zip(time_starts_A, num_reps_A)]
-    #time_starts_B = numpy.cumsum(num_reps_B) - num_reps_B[0]
-    #times_B = [slice(time_start, time_start + reps) for time_start, reps in zip(time_starts_B, num_reps_B)]
+    if repeated_measures:
+        # We haven't reworked this and don't really support repeated measures anyway
+        raise NotImplementedError
 
-    # First, join the two datasets so we can index both
-    data_joined = numpy.concatenate((data_A, data_B), axis=1)
+    timepoints_joined = numpy.concatenate((timepoints_A, timepoints_B)) % timepoints_per_cycle
 
-    # Expand data_combined out to the right number of permutations
-    #perm_data_combined = numpy.broadcast_to(data_combined, (N,*data_combined.shape)).copy()
+    indexes = numpy.tile(numpy.arange(timepoints_joined.size), (N, 1))
+    for j in range(timepoints_per_cycle):
+        # Shuffle the columns of A and B at each timepoint among themselves
+        columns = numpy.flatnonzero(timepoints_joined == j)
+        indexes[:, columns] = columns[numpy.argsort(numpy.random.random((N, columns.size)), axis=1)]
 
-    if not repeated_measures:
-        permuted_data = [numpy.concatenate([data_joined[:, numpy.random.choice(indexes, reps, replace=False)]
-                                            for indexes, reps in zip(joined_indexes, num_reps_A)], axis=1)
-                                for i in range(N)]
-        permuted_data = numpy.array(permuted_data)
-    else:
-        raise NotImplementedError
-        # We haven't reworked this and don't really support repeated measures anyway
-        num_A_replicates = times_A[0].stop - times_A[0].start
-        num_B_replicates = times_B[0].stop - times_B[0].start
-        for i in range(N):
-            shuffled_replicates = numpy.random.permutation(num_A_replicates + num_B_replicates)
-            for time_slice in times_combined:
-                perm_data_combined[i,time_slice] = perm_data_combined[i,time_slice][shuffled_replicates]
-
-    return permuted_data
+    indexes.flags.writeable = False
+    return indexes
 
 def upside_statistic(data, timepoints, timepoints_per_cycle, repeated_measures=False):
     """
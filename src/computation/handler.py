@@ -4,16 +4,36 @@ import boto3
 import numpy as np
 import simplejson as json
 
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from io import BytesIO
-from operator import itemgetter
+from time import perf_counter
 
 from algorithms import COMPARISON_ALGORITHMS, compute
-from processor import parallel_compute as parallel
+from processor import parallel_compute_all
 from notifier import send_notification_via_websockets
 
-s3 = boto3.resource("s3")
+# Objects of the views downloaded at the same time, the large ones in parts of
+# MULTIPART_CHUNK_SIZE bytes downloaded PARTS_DOWNLOADED_AT_THE_SAME_TIME at a time
+OBJECTS_DOWNLOADED_AT_THE_SAME_TIME = 4
+PARTS_DOWNLOADED_AT_THE_SAME_TIME = 8
+MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+
+s3 = boto3.resource(
+    "s3",
+    config=Config(
+        max_pool_connections=OBJECTS_DOWNLOADED_AT_THE_SAME_TIME * PARTS_DOWNLOADED_AT_THE_SAME_TIME
+    ),
+)
+transfer_configuration = TransferConfig(
+    multipart_threshold=MULTIPART_CHUNK_SIZE,
+    multipart_chunksize=MULTIPART_CHUNK_SIZE,
+    max_concurrency=PARTS_DOWNLOADED_AT_THE_SAME_TIME,
+)
+
 SPREADSHEET_BUCKET_NAME = os.environ["SPREADSHEET_BUCKET_NAME"]
 
 
@@ -23,25 +43,50 @@ class Spreadsheet:
     metadata: dict
 
 
-def load_spreadsheet(userId, spreadsheetId, viewId):
-    data = BytesIO()
-    s3.Object(
-        SPREADSHEET_BUCKET_NAME,
-        f"{userId}/spreadsheets/{spreadsheetId}/views/{viewId}/data",
-    ).download_fileobj(data)
+def load_spreadsheets(userId, spreadsheets):
+    """
+    Spreadsheets of the views of `spreadsheets`, whose data and metadata are all
+    downloaded concurrently, each spreadsheet being parsed while the objects of the
+    next ones are still downloading
+    """
+
+    with ThreadPoolExecutor(OBJECTS_DOWNLOADED_AT_THE_SAME_TIME) as executor:
+        downloads = [
+            [
+                executor.submit(download_view_object, userId, name=name, **spreadsheet)
+                for name in ["data", "metadata"]
+            ]
+            for spreadsheet in spreadsheets
+        ]
+
+        return [parse_spreadsheet(data.result(), metadata.result()) for data, metadata in downloads]
 
-    data.seek(0)
 
-    metadata = BytesIO()
-    s3.Object(
+def download_view_object(userId, spreadsheetId, viewId, name):
+    view_object = BytesIO()
+
+    # Through the client, which unlike the resource can be shared by the threads
+    s3.meta.client.download_fileobj(
         SPREADSHEET_BUCKET_NAME,
-        f"{userId}/spreadsheets/{spreadsheetId}/views/{viewId}/metadata",
-    ).download_fileobj(metadata)
+        f"{userId}/spreadsheets/{spreadsheetId}/views/{viewId}/{name}",
+        view_object,
+        Config=transfer_configuration,
+    )
+
+    view_object.seek(0)
+
+    return view_object
 
-    metadata.seek(0)
+
+def parse_spreadsheet(data, metadata):
     metadata = json.load(metadata)
 
-    data = np.loadtxt(data, delimiter=",", ndmin=2)
+    # The views stored before the binary format are in CSV
+    if metadata.get("data_format") == "npy":
+        data = np.load(data, allow_pickle=False)
+    else:
+        data = np.loadtxt(data, delimiter=",", ndmin=2)
+
     metadata["sample_collection_times"] = np.array(metadata["sample_collection_times"])
 
     return Spreadsheet(data, metadata)
@@ -55,20 +100,43 @@ def sort_by_time(spreadsheet):
 
 
 def handler(event, context):
-    analysisId, userId, algorithm = itemgetter(
-        "analysisId", "userId", "algorithm"
-    )(event)
+    """
+    Run the analyses of the event, all on the same spreadsheets, and store their results
+
+    The event either describes a single analysis, with its analysisId, algorithm,
+    computeWaveProperties, for cosinor, optional candidate periods and, for upside,
+    sequentialPermutations, or lists several of them as "analyses"; the spreadsheets are
+    loaded once and the algorithms run together.
+    """
+
+    start = perf_counter()
+
+    userId = event["userId"]
+    analyses = event.get("analyses") or [
+        {
+            "analysisId": event["analysisId"],
+            "algorithm": event["algorithm"],
+            "computeWaveProperties": event.get("computeWaveProperties", False),
+            "periods": event.get("periods"),
+            "sequentialPermutations": event.get("sequentialPermutations", False),
+        }
+    ]
+
+    comparison = [analysis["algorithm"] in COMPARISON_ALGORITHMS for analysis in analyses]
+    if any(comparison) and not all(comparison):
+        raise ValueError("Comparison algorithms can not be run together with the other algorithms.")
 
     spreadsheets = [
-        sort_by_time(load_spreadsheet(userId, **spreadsheet))
-        for spreadsheet in event["spreadsheets"]
+        sort_by_time(spreadsheet)
+        for spreadsheet in load_spreadsheets(userId, event["spreadsheets"])
     ]
 
     send_notification = send_notification_via_websockets(
-        {"userId": userId, "analysisId": analysisId}
+        {"userId": userId, "analysisIds": [analysis["analysisId"] for analysis in analyses]}
     )
 
-    if algorithm in COMPARISON_ALGORITHMS:
+    indexes = None
+    if all(comparison):
         sample_collection_times = [spreadsheet.metadata["sample_collection_times"] for spreadsheet in spreadsheets]
 
         merged_labels = sorted(set.intersection(
@@ -87,49 +155,72 @@ def handler(event, context):
             [spreadsheet.data[index, :] for spreadsheet, index in zip(spreadsheets, indexes)],
             sample_collection_times
         )
-
-        if algorithm == "differential_cosinor":
-            p_amplitude, p_phase = parallel(
-                compute(algorithm), *parameters, send_notification=send_notification
-            )
-
-            results = json.dumps({"indexes": indexes, "p_amplitude": p_amplitude, "p_phase": p_phase}, ignore_nan=True)
-        elif algorithm == "two_way_anova":
-            p_interaction, p_main_effect = parallel(
-                compute(algorithm), *parameters, send_notification=send_notification
-            )
-
-            results = json.dumps({"indexes": indexes, "p_interaction": p_interaction, "p_main_effect": p_main_effect}, ignore_nan=True)
-        else:
-            p = parallel(
-                compute(algorithm), *parameters, send_notification=send_notification
-            )
-
-            results = json.dumps({"indexes": indexes, "p": p}, ignore_nan=True)
     else:
         spreadsheet = spreadsheets.pop()
         sample_collection_times = spreadsheet.metadata["sample_collection_times"]
 
         parameters = (spreadsheet.data, sample_collection_times)
 
-        if algorithm == "jtk" and event["computeWaveProperties"]:
-            period, lag, amplitude = parallel(
-                compute(algorithm), *parameters, send_notification=send_notification, compute_wave_properties=True
-            )
-            results = json.dumps({"period": period, "lag": lag, "amplitude": amplitude}, ignore_nan=True)
-        elif algorithm == "cosinor":
-            x, p = parallel(
-                compute(algorithm), *parameters, send_notification=send_notification
-            )
-            results = json.dumps({"x": x, "p": p}, ignore_nan=True)
-        else:
-            p = parallel(
-                compute(algorithm), *parameters, send_notification=send_notification
-            )
-            results = json.dumps({"p": p}, ignore_nan=True)
-
-    s3.Object(
-        SPREADSHEET_BUCKET_NAME, f"{userId}/analyses/{analysisId}/results"
-    ).upload_fileobj(BytesIO(results.encode()))
+    computations = []
+    for analysis in analyses:
+        options = {}
+        if analysis["algorithm"] == "jtk" and analysis.get("computeWaveProperties", False):
+            options["compute_wave_properties"] = True
+        if analysis["algorithm"] == "cosinor" and analysis.get("periods"):
+            options["periods"] = analysis["periods"]
+        if analysis["algorithm"] == "upside" and analysis.get("sequentialPermutations", False):
+            options["sequential"] = True
+
+        computations.append((compute(analysis["algorithm"]), options))
+
+    print(f"Time to load spreadsheets: {perf_counter() - start:.3f} s")
+
+    all_results = parallel_compute_all(
+        computations, *parameters, send_notification=send_notification
+    )
+
+    for analysis, (_, options), results in zip(analyses, computations, all_results):
+        results = json.dumps(
+            format_results(analysis["algorithm"], results, indexes, **options),
+            ignore_nan=True,
+            default=lambda array: array.tolist(),
+        )
+
+        s3.Object(
+            SPREADSHEET_BUCKET_NAME, f"{userId}/analyses/{analysis['analysisId']}/results"
+        ).upload_fileobj(BytesIO(results.encode()))
 
     send_notification({"status": "COMPLETED"})
+
+
+def format_results(
+    algorithm, results, indexes=None, compute_wave_properties=False, periods=None, sequential=False
+):
+    if algorithm == "differential_cosinor":
+        p_amplitude, p_phase = results
+        results = {"p_amplitude": p_amplitude, "p_phase": p_phase}
+    elif algorithm == "two_way_anova":
+        p_interaction, p_main_effect = results
+        results = {"p_interaction": p_interaction, "p_main_effect": p_main_effect}
+    elif algorithm == "upside" and sequential:
+        p_A_B, p_B_A, number_of_permutations_A_B, number_of_permutations_B_A = results
+        results = {
+            "p": [p_A_B, p_B_A],
+            "number_of_permutations": [number_of_permutations_A_B, number_of_permutations_B_A],
+        }
+    elif algorithm == "jtk" and compute_wave_properties:
+        period, lag, amplitude = results
+        results = {"period": period, "lag": lag, "amplitude": amplitude}
+    elif algorithm == "cosinor" and periods:
+        x, p, period = results
+        results = {"x": x, "p": p, "period": period}
+    elif algorithm == "cosinor":
+        x, p = results
+        results = {"x": x, "p": p}
+    else:
+        results = {"p": results}
+
+    if indexes is not None:
+        results = {"indexes": indexes, **results}
+
+    return results
@@ -2,48 +2,141 @@ import boto3
 import os
 import simplejson as json
 
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from threading import Lock
+from time import monotonic
 
 NOTIFICATION_FREQUENCY = 2
 
+# Seconds during which the connections of a user are reused before being queried again
+CONNECTIONS_TIME_TO_LIVE = 10
+# Progress notifications changing the progress by less than this fraction of its
+# maximum are skipped
+MINIMUM_PROGRESS_CHANGE = 0.005
+NUMBER_OF_POSTING_THREADS = 8
+
 CONNECTION_TABLE_NAME = os.environ["CONNECTION_TABLE_NAME"]
 NOTIFICATION_API_ENDPOINT = os.environ["NOTIFICATION_API_ENDPOINT"]
 
 db = boto3.client("dynamodb")
 api = boto3.client("apigatewaymanagementapi", endpoint_url=NOTIFICATION_API_ENDPOINT)
 
+# Shared by the notifiers of all the invocations, like the clients
+executor = ThreadPoolExecutor(NUMBER_OF_POSTING_THREADS)
+
 
 def send_notification_via_websockets(context):
-    def send_notification(message):
-        user_connections = db.query(
-            TableName=CONNECTION_TABLE_NAME,
-            IndexName="userId-index",
-            KeyConditionExpression="userId = :value",
-            ExpressionAttributeValues={":value": {"S": context["userId"]}},
-        )
-
-        for connection in user_connections["Items"]:
-            try:
+    return WebsocketNotifier(context)
+
+
+class WebsocketNotifier:
+    """
+    Sender of the notifications about the analyses of `context` to the websocket
+    connections of its user
+
+    The connections are queried at most every CONNECTIONS_TIME_TO_LIVE seconds, those
+    gone are dropped, and each notification is posted to them concurrently. Progress
+    notifications which barely move the progress are skipped. The numbers of queries
+    and posts are printed once the analyses are completed.
+    """
+
+    def __init__(self, context):
+        self.context = context
+
+        self.connection_ids = []
+        self.connections_expiration = 0
+        self.last_progress = None
+
+        self.number_of_queries = 0
+        self.number_of_posts = 0
+
+        self.lock = Lock()
+
+    def __call__(self, message):
+        with self.lock:
+            if message["status"] == "RUNNING" and not self.progress_changed(message["progress"]):
+                return
+
+            connection_ids = self.user_connections()
+            results = list(executor.map(self.post, connection_ids, repeat(message)))
+
+            gone = {
+                connection_id
+                for connection_id, (_, connection_gone) in zip(connection_ids, results)
+                if connection_gone
+            }
+            self.connection_ids = [
+                connection_id for connection_id in self.connection_ids if connection_id not in gone
+            ]
+            self.number_of_posts += sum(number_of_posts for number_of_posts, _ in results)
+
+            if message["status"] == "COMPLETED":
+                print(
+                    f"Notifications of the analyses {', '.join(self.context['analysisIds'])}: "
+                    f"{self.number_of_queries} DynamoDB queries, {self.number_of_posts} posts"
+                )
+
+    def progress_changed(self, progress):
+        """Whether `progress` moved enough since the last progress notification sent"""
+
+        if (
+            self.last_progress is not None
+            and progress["value"] != progress["max"]
+            and progress["value"] - self.last_progress < MINIMUM_PROGRESS_CHANGE * progress["max"]
+        ):
+            return False
+
+        self.last_progress = progress["value"]
+        return True
+
+    def user_connections(self):
+        """Identifiers of the connections of the user, queried once they have expired"""
+
+        if monotonic() >= self.connections_expiration:
+            user_connections = db.query(
+                TableName=CONNECTION_TABLE_NAME,
+                IndexName="userId-index",
+                KeyConditionExpression="userId = :value",
+                ExpressionAttributeValues={":value": {"S": self.context["userId"]}},
+            )
+            self.number_of_queries += 1
+
+            self.connection_ids = [
+                connection["connectionId"]["S"] for connection in user_connections["Items"]
+            ]
+            self.connections_expiration = monotonic() + CONNECTIONS_TIME_TO_LIVE
+
+        return self.connection_ids
+
+    def post(self, connection_id, message):
+        """
+        Post `message` about each analysis to a connection, returning the number of
+        posts and whether the connection is gone
+        """
+
+        number_of_posts = 0
+        try:
+            for analysisId in self.context["analysisIds"]:
+                number_of_posts += 1
                 api.post_to_connection(
-                    Data=json.dumps(
-                        {"analysisId": context["analysisId"], **message}
-                    ).encode(),
-                    ConnectionId=connection["connectionId"]["S"],
+                    Data=json.dumps({"analysisId": analysisId, **message}).encode(),
+                    ConnectionId=connection_id,
                 )
-            except api.exceptions.GoneException:
-                continue
+        except api.exceptions.GoneException:
+            return number_of_posts, True
 
-    return send_notification
+        return number_of_posts, False
 
 
 def notifier(processor_connection, workload_size, send_notification):
-    while True:
-        sleep(1 / NOTIFICATION_FREQUENCY)
+    # Between notifications, wait for the processor to exit rather than sleep, so that
+    # short jobs are not held up
+    while not processor_connection.poll(1 / NOTIFICATION_FREQUENCY):
         processor_connection.send("PROGRESS_UPDATE_REQUEST")
         message = processor_connection.recv()
 
         if message == "EXIT":
-            processor_connection.close()
             break
         else:
             send_notification(
@@ -52,3 +145,5 @@ def notifier(processor_connection, workload_size, send_notification):
                     "progress": {"value": message, "max": workload_size},
                 }
             )
+
+    processor_connection.close()
@@ -1,129 +1,506 @@
+import os
+import resource
+
 from itertools import chain
+from math import ceil
 from multiprocessing import Pipe, Process
 from multiprocessing.connection import wait
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
 
 from notifier import notifier
-from numpy import ndarray
+from utilities import BlockData
+from numpy import concatenate, load, ndarray, save
+from numpy.lib.format import open_memmap
+
+BLOCK_SIZE = 1_000
+
+# Chunks of rows handed out to the workers: the first ones have INITIAL_CHUNK_SIZE rows,
+# the next ones take about TARGET_CHUNK_DURATION seconds at the observed time per row
+INITIAL_CHUNK_SIZE = BLOCK_SIZE
+MINIMUM_CHUNK_SIZE = 100
+TARGET_CHUNK_DURATION = 1
+
+# Workers are kept across jobs until they have run this many jobs or their peak resident
+# memory, in MB, reaches this threshold
+MAXIMUM_NUMBER_OF_JOBS_PER_WORKER = 100
+MAXIMUM_WORKER_MEMORY = 1_024
+
+
+def available_processors():
+    """Number of processors the process may run on, as allowed by its CPU affinity"""
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def run(connection, computations, shared_data, parameters):
+    """
+    Run the algorithms of `computations`, pairs of an algorithm and its options, on the
+    chunks of rows received through `connection` until there are none left, the rows
+    being read from the memory-mapped input data at `shared_data`
+
+    The algorithms operating on blocks all process each block in turn, those sharing
+    block data being given the same BlockData of the block, and write their outputs at
+    the rows of the chunk in the result buffers of the parent process; the others are
+    given a generator of the rows of the chunk and their results are sent back with its
+    completion, along with the peak memory of the worker.
+    """
 
+    data = attach_data(shared_data)
 
-def run(job, algorithm, data, parameters, options):
-    two_percent = job["size"] // 50 or 1
+    number_of_processed_items = 0
+    buffers = None
+
+    def report_progress(number_of_processed_items):
+        connection.send(
+            {
+                "status": "RUNNING",
+                "number_of_processed_items": number_of_processed_items,
+            }
+        )
 
-    def data_slice():
-        for processed, i in enumerate(range(job["start_index"], job["end_index"])):
+    def data_slice(start, end, number_of_processed_items):
+        two_percent = (end - start) // 50 or 1
+        for processed, i in enumerate(range(start, end)):
             if processed % two_percent == 0:
-                job["child_connection"].send(
-                    {
-                        "status": "RUNNING",
-                        "number_of_processed_items": processed,
-                    }
-                )
+                report_progress(number_of_processed_items + processed)
             yield data[i]
 
     try:
-        result = algorithm(data_slice(), *parameters, **options)
+        while True:
+            chunk = connection.recv()
+            if chunk is None:
+                break
+
+            start_index, end_index = chunk
+            started = perf_counter()
+
+            results = [[] for _ in computations]
+
+            for start in range(start_index, end_index, BLOCK_SIZE):
+                end = min(start + BLOCK_SIZE, end_index)
+                block = data[start:end]
+                block_data = BlockData(block)
+
+                for i, (algorithm, options) in enumerate(computations):
+                    if getattr(algorithm, "operates_on_blocks", False):
+                        if getattr(algorithm, "shares_block_data", False):
+                            options = {**options, "block_data": block_data}
+
+                        report_progress(number_of_processed_items)
+                        results[i].append(algorithm(block, *parameters, **options))
+                        number_of_processed_items += end - start
+
+            for i, (algorithm, options) in enumerate(computations):
+                if getattr(algorithm, "operates_on_blocks", False):
+                    results[i] = [concatenate(outputs) for outputs in zip(*results[i])]
+                else:
+                    results[i] = algorithm(
+                        data_slice(start_index, end_index, number_of_processed_items),
+                        *parameters,
+                        **options,
+                    )
+                    number_of_processed_items += end_index - start_index
+
+            if buffers is None:
+                layout = result_layout(computations, results)
+                connection.send({"status": "LAYOUT", "layout": layout})
+                buffers = [
+                    [open_memmap(path, mode="r+") for path in paths] if paths else None
+                    for paths in connection.recv()
+                ]
+
+            for i, (algorithm, _) in enumerate(computations):
+                if getattr(algorithm, "operates_on_blocks", False):
+                    for buffer, output in zip(buffers[i], results[i]):
+                        buffer[start_index:end_index] = output
+                    results[i] = None
+
+            connection.send(
+                {
+                    "status": "COMPLETED",
+                    "chunk": chunk,
+                    "duration": perf_counter() - started,
+                    "number_of_processed_items": number_of_processed_items,
+                    "result": results,
+                    "peak_memory": (
+                        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1_024
+                    ),
+                }
+            )
     except Exception as exception:
-        result = exception
+        connection.send({"status": "FAILED", "exception": exception})
+
+
+def serve(connection):
+    """
+    Run the jobs, an algorithms, data and parameters triple followed by its chunks,
+    received through `connection` until there are none left, keeping the libraries
+    imported and initialized by the algorithms between them
+    """
+
+    while True:
+        try:
+            job = connection.recv()
+        except Exception as exception:
+            connection.send({"status": "FAILED", "exception": exception})
+            break
 
-    job["child_connection"].send({"status": "COMPLETED", "result": result})
-    job["child_connection"].close()
+        if job is None:
+            break
+
+        run(connection, *job)
+
+    connection.close()
+
+
+class WorkerPool:
+    """
+    Worker processes kept across jobs, and so across the invocations of a warm container,
+    each retired after `maximum_number_of_jobs` jobs or once its peak resident memory
+    reaches `maximum_memory` MB
+    """
+
+    def __init__(
+        self,
+        maximum_number_of_jobs=MAXIMUM_NUMBER_OF_JOBS_PER_WORKER,
+        maximum_memory=MAXIMUM_WORKER_MEMORY,
+    ):
+        self.maximum_number_of_jobs = maximum_number_of_jobs
+        self.maximum_memory = maximum_memory
+        self.workers = []
+
+    def acquire(self, number_of_workers):
+        """Workers for a job, the missing ones being started"""
+
+        self.workers = [
+            worker for worker in self.workers if worker["process"].is_alive()
+        ]
+
+        while len(self.workers) < number_of_workers:
+            parent_connection, child_connection = Pipe()
+            process = Process(target=serve, args=(child_connection,), daemon=True)
+            process.start()
+            child_connection.close()
+
+            self.workers.append(
+                {
+                    "connection": parent_connection,
+                    "process": process,
+                    "number_of_jobs": 0,
+                    "peak_memory": 0,
+                }
+            )
+
+        return self.workers[:number_of_workers]
+
+    def release(self, workers):
+        """Return the workers of a completed job, retiring those past their limits"""
+
+        for worker in workers:
+            worker["number_of_jobs"] += 1
+
+            if (
+                worker["number_of_jobs"] >= self.maximum_number_of_jobs
+                or worker["peak_memory"] >= self.maximum_memory
+            ):
+                worker["connection"].send(None)
+                worker["connection"].close()
+                worker["process"].join()
+                self.workers.remove(worker)
+
+    def terminate(self):
+        """Stop all the workers, whose state is unknown after a failed job"""
+
+        for worker in self.workers:
+            worker["process"].terminate()
+            worker["process"].join()
+            worker["connection"].close()
+
+        self.workers = []
+
+
+pool = WorkerPool()
+
+
+def result_layout(computations, results):
+    """
+    Data types and shapes of a row of each output of the algorithms operating on
+    blocks, from their results on a chunk
+    """
+
+    return [
+        [(output.dtype.str, output.shape[1:]) for output in outputs]
+        if getattr(algorithm, "operates_on_blocks", False)
+        else None
+        for (algorithm, _), outputs in zip(computations, results)
+    ]
+
+
+def chunk_size(duration_per_row, number_of_remaining_rows, number_of_processors):
+    """
+    Number of rows of the next chunk: enough to take about TARGET_CHUNK_DURATION seconds,
+    but shrinking with the remaining rows so that the workers finish together
+    """
+
+    if duration_per_row is None:
+        size = INITIAL_CHUNK_SIZE
+    else:
+        size = round(TARGET_CHUNK_DURATION / max(duration_per_row, 1e-9))
+
+    size = min(size, ceil(number_of_remaining_rows / (2 * number_of_processors)))
+
+    return min(max(size, MINIMUM_CHUNK_SIZE), number_of_remaining_rows)
 
 
 def parallel_compute(
-    algorithm, data, *parameters, send_notification, number_of_processors=6, **options
+    algorithm, data, *parameters, send_notification, number_of_processors=None, **options
+):
+    (results,) = parallel_compute_all(
+        [(algorithm, options)],
+        data,
+        *parameters,
+        send_notification=send_notification,
+        number_of_processors=number_of_processors,
+    )
+
+    return results
+
+
+def parallel_compute_all(
+    computations, data, *parameters, send_notification, number_of_processors=None
 ):
+    """
+    Results of all the algorithms of `computations`, pairs of an algorithm and its
+    options, run on `data` by the same worker processes, with their progress reported
+    together
+
+    The workers come from the persistent pool. The input data is written once to
+    memory-mapped files, which the workers read their rows from. They pull chunks of
+    rows, sized from the observed time per row, until all the rows are processed. The
+    outputs of the algorithms operating on blocks are written by the workers into
+    memory-mapped files and returned as arrays mapped onto them.
+    """
+
     if not isinstance(data, ndarray):
         data = MultipleSpreadsheet(data)
 
+    if number_of_processors is None:
+        number_of_processors = available_processors()
+
     workload_size = len(data)
 
-    jobs = []
-    for i in range(number_of_processors):
-        parent_connection, child_connection = Pipe(False)
-        jobs.append(
-            {
-                "parent_connection": parent_connection,
-                "child_connection": child_connection,
-                "number_of_processed_items": 0,
-                "process": None,
-                "result": None,
-            }
+    if workload_size == 0:
+        return empty_results(computations, data, parameters)
+
+    next_row = 0
+    processed_rows = 0
+    total_duration = 0
+
+    def next_chunk():
+        nonlocal next_row
+
+        if next_row == workload_size:
+            return None
+
+        size = chunk_size(
+            total_duration / processed_rows if processed_rows else None,
+            workload_size - next_row,
+            number_of_processors,
         )
 
-    for i in range(number_of_processors):
-        jobs[i]["start_index"] = i * (workload_size // number_of_processors)
-        jobs[i]["end_index"] = (i + 1) * (workload_size // number_of_processors)
+        chunk = (next_row, next_row + size)
+        next_row += size
+        return chunk
 
-    for i in range(number_of_processors):
-        if i < workload_size % number_of_processors:
-            jobs[i]["start_index"] += i
-            jobs[i]["end_index"] += i + 1
-        else:
-            jobs[i]["start_index"] += workload_size % number_of_processors
-            jobs[i]["end_index"] += workload_size % number_of_processors
+    with TemporaryDirectory() as directory:
+        shared_data = share_data(data, directory)
 
-        jobs[i]["size"] = jobs[i]["end_index"] - jobs[i]["start_index"]
+        layout = None
+        buffer_paths = None
+        legacy_results = {}
 
-    # Start the notifier
-    notifier_parent_connection, notifier_child_connection = Pipe()
-    notifier_process = Process(
-        target=notifier,
-        args=(notifier_child_connection, workload_size, send_notification),
-    )
-    notifier_process.start()
-
-    # Start jobs
-    running = {}
-    for job in jobs:
-        process = Process(target=run, args=(job, algorithm, data, parameters, options))
-        job["process"] = process
-        running[job["parent_connection"]] = job
-        process.start()
-
-    # Wait for jobs to complete
-    while running:
-        connections = chain(running, [notifier_parent_connection])
-        for connection in wait(connections):
-            message = connection.recv()
-
-            if isinstance(message, Exception):
-                raise message
-
-            if message == "PROGRESS_UPDATE_REQUEST":
-                notifier_parent_connection.send(
-                    sum(job["number_of_processed_items"] for job in jobs)
-                )
+        workers = pool.acquire(number_of_processors)
+        jobs = [{"worker": worker, "number_of_processed_items": 0} for worker in workers]
+
+        # Start the notifier, in a thread so that it shares the connections cached by
+        # `send_notification` with the other notifications of the job
+        notifier_parent_connection, notifier_child_connection = Pipe()
+        notifier_thread = Thread(
+            target=notifier,
+            args=(
+                notifier_child_connection,
+                workload_size * len(computations),
+                send_notification,
+            ),
+            daemon=True,
+        )
+        notifier_thread.start()
+
+        running = {}
+
+        try:
+            # Start jobs
+            for job in jobs:
+                connection = job["worker"]["connection"]
+                connection.send((computations, shared_data, parameters))
+
+                chunk = next_chunk()
+                connection.send(chunk)
+                if chunk is not None:
+                    running[connection] = job
+
+            # Hand out chunks until all the rows are processed
+            while running:
+                connections = chain(running, [notifier_parent_connection])
+                for connection in wait(connections):
+                    message = connection.recv()
+
+                    if isinstance(message, Exception):
+                        raise message
+
+                    if message == "PROGRESS_UPDATE_REQUEST":
+                        notifier_parent_connection.send(
+                            sum(job["number_of_processed_items"] for job in jobs)
+                        )
+                        continue
+
+                    job = running[connection]
+
+                    if message["status"] == "FAILED":
+                        raise message["exception"]
+
+                    if message["status"] == "RUNNING":
+                        job["number_of_processed_items"] = message["number_of_processed_items"]
+
+                    if message["status"] == "LAYOUT":
+                        if buffer_paths is None:
+                            layout = message["layout"]
+                            buffer_paths = allocate_result_buffers(
+                                directory, layout, workload_size
+                            )
+                        elif message["layout"] != layout:
+                            raise ValueError("The workers reported different result layouts")
+                        connection.send(buffer_paths)
+
+                    if message["status"] == "COMPLETED":
+                        start, end = message["chunk"]
+                        processed_rows += end - start
+                        total_duration += message["duration"]
+
+                        job["number_of_processed_items"] = message["number_of_processed_items"]
+                        job["worker"]["peak_memory"] = message["peak_memory"]
+                        legacy_results[start] = message["result"]
+
+                        chunk = next_chunk()
+                        connection.send(chunk)
+                        if chunk is None:
+                            del running[connection]
+        except BaseException:
+            pool.terminate()
+            notifier_parent_connection.send("EXIT")
+            notifier_thread.join()
+            notifier_parent_connection.close()
+            raise
+
+        send_notification({"status": "FINALIZING"})
+
+        notifier_parent_connection.send("EXIT")
+
+        pool.release(workers)
+
+        # Closed only once the notifier is done, so that it can still send a last request
+        notifier_thread.join()
+        notifier_parent_connection.close()
+
+        # Rows of the legacy results in order
+        chunk_results = [legacy_results[start] for start in sorted(legacy_results)]
+
+        all_results = []
+        for i, (algorithm, _) in enumerate(computations):
+            if getattr(algorithm, "operates_on_blocks", False):
+                # Mapped onto the buffers, which stay readable once their files are removed
+                results = [load(path, mmap_mode="r") for path in buffer_paths[i]]
             else:
-                job = running[connection]
-                if message["status"] == "RUNNING":
-                    job["number_of_processed_items"] = message[
-                        "number_of_processed_items"
-                    ]
+                results = list(
+                    map(list, map(chain.from_iterable, zip(*(result[i] for result in chunk_results))))
+                )
 
-                if message["status"] == "COMPLETED":
-                    job["result"] = message["result"]
-                    if isinstance(job["result"], Exception):
-                        raise job["result"]
-                    else:
-                        job["number_of_processed_items"] = job["size"]
-                        del running[connection]
+            all_results.append(results if len(results) > 1 else results.pop())
 
-    send_notification({"status": "FINALIZING"})
+    return all_results
 
-    notifier_parent_connection.send("EXIT")
-    notifier_parent_connection.close()
 
-    for job in jobs:
-        job["parent_connection"].close()
-        job["process"].join()
+def empty_results(computations, data, parameters):
+    """
+    Results of the algorithms of `computations` for `data` without rows, computed in
+    this process since no chunk would be handed out to the workers
+    """
 
-    notifier_process.join()
+    all_results = []
+    for algorithm, options in computations:
+        if getattr(algorithm, "operates_on_blocks", False):
+            results = list(algorithm(data[0:0], *parameters, **options))
+        else:
+            results = list(map(list, algorithm(iter(()), *parameters, **options)))
+
+        all_results.append(results if len(results) > 1 else results.pop())
+
+    return all_results
 
-    results = list(
-        map(list, map(chain.from_iterable, zip(*(job["result"] for job in jobs))))
-    )
 
-    return results if len(results) > 1 else results.pop()
+def share_data(data, directory):
+    """
+    Paths of copies in `directory` of the array of `data`, or of its arrays for several
+    spreadsheets, to be memory-mapped by the workers instead of inherited or pickled
+    """
+
+    arrays = data.spreadsheets if isinstance(data, MultipleSpreadsheet) else [data]
+
+    paths = []
+    for i, array in enumerate(arrays):
+        path = os.path.join(directory, f"data_{i}.npy")
+        save(path, array)
+        paths.append(path)
+
+    return paths if isinstance(data, MultipleSpreadsheet) else paths.pop()
+
+
+def attach_data(paths):
+    """Read-only memory-mapped input data at `paths`, as written by share_data"""
+
+    if isinstance(paths, str):
+        return load(paths, mmap_mode="r")
+
+    return MultipleSpreadsheet([load(path, mmap_mode="r") for path in paths])
+
+
+def allocate_result_buffers(directory, layout, number_of_rows):
+    """
+    Paths of memory-mapped files in `directory` holding the outputs of all the rows
+    of the algorithms operating on blocks, with the data types and row shapes of
+    `layout`
+    """
+
+    paths = []
+    for i, outputs in enumerate(layout):
+        if outputs is None:
+            paths.append(None)
+            continue
+
+        paths.append([])
+        for j, (dtype, shape) in enumerate(outputs):
+            path = os.path.join(directory, f"{i}_{j}.npy")
+            open_memmap(
+                path, mode="w+", dtype=dtype, shape=(number_of_rows, *shape)
+            ).flush()
+            paths[i].append(path)
+
+    return paths
 
 
 class MultipleSpreadsheet:
@@ -134,4 +511,7 @@ class MultipleSpreadsheet:
         return len(self.spreadsheets[0])
 
     def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(spreadsheet[i] for spreadsheet in self.spreadsheets)
+
         return (spreadsheet[i] for spreadsheet in self.spreadsheets)
@@ -0,0 +1,108 @@
+# %%
+import sys
+import numpy as np
+
+from time import perf_counter
+
+sys.path.append("..")
+from algorithms import compute
+
+rng = np.random.default_rng(0)
+
+
+def synthetic_spreadsheet(number_of_rows, timepoints, missing_values_fraction=0.05):
+    ω = 2 * np.pi / 24
+
+    data = rng.normal(size=(number_of_rows, timepoints.size)) + rng.uniform(
+        0, 2, size=(number_of_rows, 1)
+    ) * np.cos(ω * timepoints - rng.uniform(0, 2 * np.pi, size=(number_of_rows, 1)))
+    data[rng.random(data.shape) < missing_values_fraction] = np.nan
+
+    return data
+
+
+def benchmark(algorithm, data, *parameters, **options):
+    start = perf_counter()
+    compute(algorithm)(data, *parameters, **options)
+    elapsed_time = perf_counter() - start
+
+    print(
+        f"{algorithm:>16} {len(data):>7} rows {elapsed_time:8.3f} s "
+        f"{1e6 * elapsed_time / len(data):8.1f} µs/row"
+    )
+
+
+timepoints = np.repeat(np.arange(0, 48, 2.0), 2)
+
+spreadsheets = {
+    number_of_rows: synthetic_spreadsheet(number_of_rows, timepoints)
+    for number_of_rows in [10_000, 50_000]
+}
+
+# %%
+# The first run starts without the cached null distributions, in memory and on disk,
+# as in a new container, but with the algorithms already imported
+import shutil
+
+from algorithms.jtk.algorithm import DISTRIBUTION_CACHE_DIRECTORY, jtk_distribution
+from algorithms.rain.algorithm import (
+    jonckheere_distribution,
+    mann_whitney_distribution,
+    umbrella_distribution,
+)
+
+
+def clear_caches():
+    shutil.rmtree(DISTRIBUTION_CACHE_DIRECTORY, ignore_errors=True)
+
+    for cached in [
+        jtk_distribution,
+        umbrella_distribution,
+        jonckheere_distribution,
+        mann_whitney_distribution,
+    ]:
+        cached.cache_clear()
+
+
+for algorithm in ["jtk", "rain"]:
+    clear_caches()
+
+    for start in ["cold", "warm"]:
+        print(f"{start:>4} start", end="")
+        benchmark(algorithm, spreadsheets[10_000], timepoints)
+
+# %%
+for algorithm in ["cosinor", "one_way_anova", "ls", "jtk"]:
+    for data in spreadsheets.values():
+        benchmark(algorithm, data, timepoints)
+
+# %%
+# Cosinor at the best of 9 candidate periods against the single period above
+for data in spreadsheets.values():
+    benchmark("cosinor", data, timepoints, periods=np.arange(20, 29))
+
+# %%
+# Loading the data of a view from CSV, as stored before, and from the npy format
+from io import BytesIO
+
+view_data_loaders = {
+    "csv": (
+        lambda view, data: np.savetxt(view, data, delimiter=","),
+        lambda view: np.loadtxt(view, delimiter=",", ndmin=2),
+    ),
+    "npy": (
+        lambda view, data: np.save(view, data, allow_pickle=False),
+        lambda view: np.load(view, allow_pickle=False),
+    ),
+}
+
+data = synthetic_spreadsheet(50_000, np.arange(0, 200, 2.0))
+
+for data_format, (save, load) in view_data_loaders.items():
+    view = BytesIO()
+    save(view, data)
+    view.seek(0)
+
+    start = perf_counter()
+    assert np.array_equal(load(view), data, equal_nan=True)
+    print(f"{data_format:>4} {len(view.getvalue()) / 1e6:8.1f} MB {perf_counter() - start:8.3f} s")
@@ -13,6 +13,9 @@ from algorithms import compute
 R.r.library("MetaCycle")
 meta2d = R.r["meta2d"]
 
+R.r.library("rain")
+rain = R.r["rain"]
+
 pandas2ri.activate()
 
 spreadsheets = {}
@@ -127,6 +130,29 @@ for data_directory, spreadsheet in spreadsheets.items():
     print("CORRELATION MATRIX")
     print(df[["jtk_p", "meta2d", "p"]].corr())
 
+    ###### RAIN ######
+
+    print("RAIN")
+
+    (p,) = compute("rain")(data, timepoints, cycle_length)
+
+    df["p"] = p
+
+    Δt = np.diff(np.unique(timepoints))[0]
+    results = rain(
+        R.r.matrix(R.FloatVector(data.ravel()), nrow=data.shape[1]),
+        period=cycle_length,
+        deltat=Δt,
+        measure_sequence=R.IntVector(np.bincount(np.round(timepoints / Δt).astype(int))),
+        na_rm=True,
+    )
+
+    df["rain"] = np.array(results.rx2("pVal"))
+
+    print(df[["rain", "p"]])
+    print("CORRELATION MATRIX")
+    print(df[["rain", "p"]].corr())
+
     ###### ARSER ######
 
     print("ARSER")
@@ -142,3 +168,44 @@ for data_directory, spreadsheet in spreadsheets.items():
     print(df[["ars_p", "p"]])
     print("CORRELATION MATRIX")
     print(df[["ars_p", "p"]].corr())
+
+# %%
+from scipy.signal import lombscargle
+from algorithms.ls.algorithm import (
+    MAXIMUM_PERIOD,
+    MINIMUM_PERIOD,
+    periodogram,
+    periodogram_of_complete_rows,
+)
+
+# scipy.signal.lombscargle computes each periodogram from the finite values of a row
+# alone, with a factor 1/2 which the algorithm leaves out
+print("LOMB-SCARGLE PERIODOGRAMS AGAINST SCIPY")
+
+for data_directory, spreadsheet in spreadsheets.items():
+    timepoints = 1.0*np.array(spreadsheet["metadata"]["timepoints"])
+    ω = 2 * np.pi * np.linspace(
+        1 / MAXIMUM_PERIOD, 1 / MINIMUM_PERIOD, 4 * timepoints.size
+    )
+
+    data = spreadsheet["data"]
+    finite = np.isfinite(data)
+    complete = np.all(finite, axis=1)
+    r = np.where(finite, data - np.nanmean(data, axis=1, keepdims=True), 0)
+
+    reference = np.array([
+        2 * lombscargle(timepoints[mask], row[mask], ω) for row, mask in zip(r, finite)
+    ])
+
+    for name, rows, computed in [
+        ("complete", complete, periodogram_of_complete_rows(r[complete], timepoints, ω)),
+        ("incomplete", ~complete, periodogram(r[~complete], finite[~complete], timepoints, ω)),
+    ]:
+        if not np.any(rows):
+            continue
+
+        print(
+            f"{data_directory:>8} {np.sum(rows):>6} {name} rows, "
+            f"maximum difference {np.max(np.abs(computed - reference[rows])):.2e} "
+            f"(maximum power {np.max(reference[rows]):.2e})"
+        )
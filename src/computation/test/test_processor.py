@@ -0,0 +1,158 @@
+# %%
+import sys
+import numpy as np
+
+sys.path.append("..")
+from algorithms import compute, operates_on_blocks
+import processor
+from processor import WorkerPool, parallel_compute, parallel_compute_all
+
+rng = np.random.default_rng(0)
+
+timepoints = np.repeat(np.arange(0, 48, 2.0), 2)
+data = rng.normal(size=(5_000, timepoints.size))
+data[rng.random(data.shape) < 0.05] = np.nan
+
+notifications = []
+send_notification = notifications.append
+
+
+def means(rows, *parameters):
+    """Algorithm without blocks, to check the order of the rows of its results"""
+    return [[np.nanmean(row) for row in rows]]
+
+
+@operates_on_blocks
+def failing(data, *parameters):
+    raise ValueError("Failing algorithm")
+
+
+@operates_on_blocks
+def inconsistent(data, *parameters):
+    """Algorithm whose output has another data type after the first row"""
+    return [np.zeros(len(data), dtype=np.float64 if np.isinf(data[0, 0]) else np.float32)]
+
+# %%
+# Without rows no worker is started, and each algorithm still has all its outputs
+x, p = parallel_compute(
+    compute("cosinor"),
+    data[:0],
+    timepoints,
+    24,
+    send_notification=send_notification,
+)
+assert x.shape == p.shape == (0,)
+
+(x, p), p_jtk = parallel_compute_all(
+    [(compute("cosinor"), {}), (compute("jtk"), {})],
+    data[:0],
+    timepoints,
+    send_notification=send_notification,
+)
+assert x.shape == p.shape == p_jtk.shape == (0,)
+
+p, *_ = parallel_compute(
+    compute("differential_cosinor"),
+    [data[:0], data[:0]],
+    [timepoints, timepoints],
+    send_notification=send_notification,
+)
+assert p.shape == (0,)
+
+print("EMPTY WORKLOAD: OK")
+
+# %%
+# The rows are processed in several chunks by several workers and put back in order, with
+# differences only in rounding from the different groupings of the rows
+x, p = parallel_compute(
+    compute("cosinor"),
+    data,
+    timepoints,
+    send_notification=send_notification,
+    number_of_processors=3,
+)
+expected_x, expected_p = compute("cosinor")(data, timepoints)
+assert np.allclose(x, expected_x, rtol=1e-12, atol=1e-12)
+assert np.allclose(p, expected_p, rtol=1e-12, atol=1e-12)
+
+row_means = parallel_compute(
+    means, data, timepoints, send_notification=send_notification, number_of_processors=3
+)
+assert np.array_equal(row_means, np.nanmean(data, axis=1))
+
+print("CHUNK ORDERING: OK")
+
+# %%
+# The exception of a failing worker is raised in the calling process, and the workers,
+# in an unknown state, are replaced for the next job
+processes = [worker["process"] for worker in processor.pool.workers]
+
+try:
+    parallel_compute(
+        failing, data, timepoints, send_notification=send_notification, number_of_processors=3
+    )
+except ValueError as error:
+    assert str(error) == "Failing algorithm"
+else:
+    raise AssertionError("The failure of the worker was not raised")
+
+assert processor.pool.workers == []
+assert not any(process.is_alive() for process in processes)
+
+x, p = parallel_compute(
+    compute("cosinor"), data, timepoints, send_notification=send_notification
+)
+assert np.allclose(p, expected_p, rtol=1e-12, atol=1e-12)
+assert all(worker["process"] not in processes for worker in processor.pool.workers)
+
+print("FAILING WORKER: OK")
+
+# %%
+# The results of the workers are written into the same buffers, so they must all have the
+# layout of the first one
+marked_data = data.copy()
+marked_data[0, 0] = np.inf
+
+try:
+    parallel_compute(
+        inconsistent,
+        marked_data,
+        timepoints,
+        send_notification=send_notification,
+        number_of_processors=3,
+    )
+except ValueError as error:
+    assert str(error) == "The workers reported different result layouts"
+else:
+    raise AssertionError("The different result layouts were not detected")
+
+assert processor.pool.workers == []
+
+print("RESULT LAYOUTS: OK")
+
+# %%
+# Workers are kept across jobs until they reach their limits
+worker_pool = WorkerPool(maximum_number_of_jobs=2, maximum_memory=1_024)
+
+workers = worker_pool.acquire(2)
+processes = [worker["process"] for worker in workers]
+assert all(process.is_alive() for process in processes)
+worker_pool.release(workers)
+
+workers = worker_pool.acquire(3)
+assert [worker["process"] for worker in workers[:2]] == processes
+assert len(worker_pool.workers) == 3
+
+# The first two workers have now run two jobs, and the third reached its memory limit
+workers[2]["peak_memory"] = 1_024
+worker_pool.release(workers)
+assert worker_pool.workers == []
+assert not any(worker["process"].is_alive() for worker in workers)
+
+workers = worker_pool.acquire(1)
+assert workers[0]["process"] not in processes
+worker_pool.terminate()
+assert worker_pool.workers == []
+assert not workers[0]["process"].is_alive()
+
+print("WORKER POOL: OK")
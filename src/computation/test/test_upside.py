@@ -0,0 +1,94 @@
+# %%
+import sys
+import numpy as np
+
+sys.path.append("..")
+from algorithms import compute
+from algorithms.upside.upside import (
+    N_EXCEEDANCES,
+    N_PERMS,
+    N_PERMS_SEQUENTIAL,
+    main,
+    permutation_indexes,
+    upside_statistic,
+)
+
+rng = np.random.default_rng(0)
+
+timepoints_per_cycle = 6
+timepoints = np.repeat(np.arange(timepoints_per_cycle), 3)
+
+# Rows without any dampening, which stop early, and rows strongly dampening from A to B,
+# which are permuted up to N_PERMS_SEQUENTIAL times in that direction
+wave = 20.0 * (-1) ** timepoints
+data_A = rng.normal(size=(40, timepoints.size))
+data_B = rng.normal(size=(40, timepoints.size))
+data_A[:10] += wave
+
+perm_indexes = permutation_indexes(timepoints, timepoints, timepoints_per_cycle, N_PERMS_SEQUENTIAL)
+
+# %%
+# Each row stops at the permutation giving its N_EXCEEDANCES-th permuted statistic at least
+# its statistic, or else takes all the permutations
+p, number_of_permutations = main(
+    timepoints,
+    data_A,
+    timepoints,
+    data_B,
+    timepoints_per_cycle,
+    sequential=True,
+    block_size=50_000,
+    perm_indexes=perm_indexes,
+)
+
+data_B_normalized = data_B + (np.nanmedian(data_A, axis=1) - np.nanmedian(data_B, axis=1))[:, None]
+data_joined = np.concatenate((data_A, data_B_normalized), axis=1)
+directions = [np.arange(timepoints.size), np.arange(timepoints.size, 2 * timepoints.size)]
+
+for i, columns in enumerate(directions):
+    stat = upside_statistic(data_joined[:, columns], timepoints, timepoints_per_cycle)
+    perm_stat = upside_statistic(
+        data_joined[:, perm_indexes[:, columns]].transpose(1, 0, 2),
+        timepoints,
+        timepoints_per_cycle,
+    )
+    exceedances = np.cumsum(perm_stat >= stat, axis=0)
+
+    for row, n in enumerate(number_of_permutations[i]):
+        if n < N_PERMS_SEQUENTIAL:
+            assert exceedances[n - 1, row] == N_EXCEEDANCES
+            assert n == 1 or exceedances[n - 2, row] == N_EXCEEDANCES - 1
+            assert p[i, row] == N_EXCEEDANCES / n
+        else:
+            assert exceedances[-1, row] <= N_EXCEEDANCES
+            assert p[i, row] == (exceedances[-1, row] + 1) / (N_PERMS_SEQUENTIAL + 1)
+
+assert np.all(number_of_permutations[1] < N_PERMS_SEQUENTIAL)
+assert np.all(number_of_permutations[0, :10] == N_PERMS_SEQUENTIAL)
+
+print("SEQUENTIAL PERMUTATIONS: OK")
+
+# %%
+# Without sequential mode, every row takes N_PERMS permutations
+p, number_of_permutations = main(
+    timepoints, data_A, timepoints, data_B, timepoints_per_cycle, perm_indexes=perm_indexes
+)
+assert np.all(number_of_permutations == N_PERMS)
+
+for i, columns in enumerate(directions):
+    stat = upside_statistic(data_joined[:, columns], timepoints, timepoints_per_cycle)
+    perm_stat = upside_statistic(
+        data_joined[:, perm_indexes[:N_PERMS, columns]].transpose(1, 0, 2),
+        timepoints,
+        timepoints_per_cycle,
+    )
+    assert np.array_equal(p[i], (np.sum(perm_stat >= stat, axis=0) + 1) / (N_PERMS + 1))
+
+# The analysis returns the numbers of permutations only in sequential mode
+results = compute("upside")([data_A, data_B], [timepoints * 4.0, timepoints * 4.0])
+assert len(results) == 2 and all(result.shape == (40,) for result in results)
+
+results = compute("upside")([data_A, data_B], [timepoints * 4.0, timepoints * 4.0], sequential=True)
+assert len(results) == 4 and all(result.shape == (40,) for result in results)
+
+print("FIXED PERMUTATIONS: OK")
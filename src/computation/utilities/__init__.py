@@ -1,5 +1,8 @@
 import numpy as np
 
+from dataclasses import dataclass
+from functools import cached_property
+
 
 def remove_missing_values(y, sample_collection_times):
     indices_of_finite_values_of_y = np.isfinite(y)
@@ -13,11 +16,108 @@ def enough_timepoints(t, cycle_length):
     return len(set(t % cycle_length)) >= 3
 
 
-def find_indices_with_enough_timepoints(batch, sample_collection_times, cycle_length):
-    indices = []
-    for i, y in enumerate(batch):
-        _, t = remove_missing_values(y, sample_collection_times)
-        if enough_timepoints(t, cycle_length):
-            indices.append(i)
+def find_indices_with_enough_timepoints(grouping, sample_collection_times, cycle_length):
+    indices = [
+        group.indices
+        for group in grouping
+        if group.has_enough_timepoints(sample_collection_times, cycle_length)
+    ]
+
+    return np.sort(np.concatenate(indices)) if indices else np.array([], dtype=int)
+
+
+@dataclass
+class RowGroup:
+    """Rows, at `indices` in their batch, whose finite values are those of `mask`"""
+
+    mask: np.ndarray
+    indices: np.ndarray
+
+    def has_enough_timepoints(self, sample_collection_times, cycle_length):
+        """Whether the finite values cover enough timepoints of the cycle"""
+
+        return enough_timepoints(sample_collection_times[self.mask], cycle_length)
+
+
+def group_by_missing_values(batch):
+    """A RowGroup for each set of rows of `batch` sharing the same finite values"""
+
+    finite = np.isfinite(batch)
+
+    masks, inverse = np.unique(finite, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    order = np.argsort(inverse, kind="stable")
+    boundaries = np.cumsum(np.bincount(inverse, minlength=len(masks)))[:-1]
+
+    return [
+        RowGroup(mask, indices) for mask, indices in zip(masks, np.split(order, boundaries))
+    ]
+
+
+class BlockData:
+    """
+    What the algorithms derive from the rows of `block`, computed when first used and
+    then shared by all the algorithms run on the block
+    """
+
+    def __init__(self, block):
+        self.block = block
+
+    @cached_property
+    def grouping(self):
+        """Missing values grouping of the rows, see group_by_missing_values"""
+
+        return group_by_missing_values(self.block)
+
+    @cached_property
+    def pairwise_signs(self):
+        """Signs of the differences between all pairs of samples, see pairwise_signs"""
+
+        return pairwise_signs(self.block)
+
+
+def ranks(batch):
+    """
+    Dense ranks, from 1, of the values of each row of `batch`, tied values sharing
+    their rank and missing values ranked 0, in the smallest integer type holding them
+    """
+
+    dtype = np.min_scalar_type(-batch.shape[1] - 1)
+
+    order = np.argsort(batch, axis=1)
+    sorted_batch = np.take_along_axis(batch, order, axis=1)
+
+    new_values = np.ones(batch.shape, dtype=dtype)
+    new_values[:, 1:] = sorted_batch[:, 1:] != sorted_batch[:, :-1]
+
+    dense_ranks = np.empty(batch.shape, dtype=dtype)
+    np.put_along_axis(dense_ranks, order, np.cumsum(new_values, axis=1, dtype=dtype), axis=1)
+    dense_ranks[np.isnan(batch)] = 0
+
+    return dense_ranks
+
+
+def pairwise_signs(batch):
+    """
+    Signs of the differences y[j] - y[i] between the values of all pairs of samples
+    i < j of each row of `batch`, 0 for the pairs with a missing value, as float32 for
+    the matrix products of the rank-based algorithms
+
+    The differences of the ranks of the values, small integers, have the same signs
+    and are much faster to compute. The signs are read-only, being shared by the
+    algorithms run on the same block through its BlockData.
+    """
+
+    first, second = np.triu_indices(batch.shape[1], k=1)
+
+    batch_ranks = ranks(batch)
+    first_ranks, second_ranks = batch_ranks[:, first], batch_ranks[:, second]
+
+    signs = np.sign(second_ranks - first_ranks)
+    signs *= np.minimum(first_ranks, second_ranks) > 0
+
+    signs = signs.astype(np.float32)
+    signs.flags.writeable = False
 
-    return np.array(indices)
+    return signs
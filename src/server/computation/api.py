@@ -1,11 +1,12 @@
 import boto3
+import numpy as np
 import os
 import simplejson as json
 
 from hashlib import sha256
 from io import BytesIO
 
-from flask import Blueprint, request
+from flask import Blueprint, jsonify, request
 
 from botocore.client import Config
 from botocore.exceptions import ClientError
@@ -19,26 +20,41 @@ s3_client = boto3.client("s3", config=Config(s3={"addressing_style": "virtual"})
 sfn = boto3.client("stepfunctions")
 
 ALGORITHMS = ["cosinor", "differential_cosinor", "ls", "arser", "jtk", "one_way_anova", "two_way_anova", "rain", "upside"]
+COMPARISON_ALGORITHMS = ["differential_cosinor", "two_way_anova", "upside"]
 COMPUTATION_STATE_MACHINE_ARN = os.environ["COMPUTATION_STATE_MACHINE_ARN"]
 SPREADSHEET_BUCKET_NAME = os.environ["SPREADSHEET_BUCKET_NAME"]
 
+# Format of the data of the views, recorded in their metadata: "npy" for NumPy's binary
+# format, the views without it being in CSV
+VIEW_DATA_FORMAT = "npy"
+
 environment = os.environ["ENV"]
 
 analysis_blueprint = Blueprint("analysis", __name__)
 
 
-def run(analysis):
-    analysisId = sha256(
+def get_analysis_id(analysis):
+    return sha256(
         json.dumps(analysis, separators=(",", ":"), sort_keys=True).encode()
     ).hexdigest()
 
-    try:
-        s3.Object(
-            SPREADSHEET_BUCKET_NAME,
-            f"{analysis['userId']}/analyses/{analysisId}/parameters",
-        ).upload_fileobj(
-            BytesIO(json.dumps({"analysisId": analysisId, **analysis}).encode())
+
+def store_analysis_parameters(analysisId, analysis, **extra_parameters):
+    s3.Object(
+        SPREADSHEET_BUCKET_NAME,
+        f"{analysis['userId']}/analyses/{analysisId}/parameters",
+    ).upload_fileobj(
+        BytesIO(
+            json.dumps({"analysisId": analysisId, **analysis, **extra_parameters}).encode()
         )
+    )
+
+
+def run(analysis):
+    analysisId = get_analysis_id(analysis)
+
+    try:
+        store_analysis_parameters(analysisId, analysis)
 
         sfn.start_execution(
             stateMachineArn=COMPUTATION_STATE_MACHINE_ARN,
@@ -54,17 +70,59 @@ def run(analysis):
     return analysisId
 
 
-@analysis_blueprint.route("/", methods=["post"])
-@ajax_requires_account_or_share
-def submit_analysis(user):
-    parameters = request.get_json()
+def run_all(analyses):
+    """
+    Run the `analyses` of the same spreadsheets in a single execution, which loads the
+    spreadsheets once, and return their analysisIds
 
-    if parameters["algorithm"] not in ALGORITHMS:
-        raise NotImplementedError
+    Each analysis keeps the analysisId and parameters it would have on its own, the
+    parameters also recording the name of the execution for its status.
+    """
 
+    analysisIds = [get_analysis_id(analysis) for analysis in analyses]
+    executionName = sha256(",".join(analysisIds).encode()).hexdigest()
+
+    userId = analyses[0]["userId"]
+    spreadsheets = analyses[0]["spreadsheets"]
+
+    try:
+        for analysisId, analysis in zip(analysisIds, analyses):
+            store_analysis_parameters(analysisId, analysis, executionName=executionName)
+
+        sfn.start_execution(
+            stateMachineArn=COMPUTATION_STATE_MACHINE_ARN,
+            name=executionName,
+            input=json.dumps(
+                {
+                    "userId": userId,
+                    "spreadsheets": spreadsheets,
+                    "analyses": [
+                        {
+                            "analysisId": analysisId,
+                            **{
+                                key: value
+                                for key, value in analysis.items()
+                                if key not in ["userId", "spreadsheets"]
+                            },
+                        }
+                        for analysisId, analysis in zip(analysisIds, analyses)
+                    ],
+                }
+            ),
+            traceHeader=executionName,
+        )
+    except sfn.exceptions.ExecutionAlreadyExists as error:
+        # Already ran/running, so we just need to let them know about it
+        return jsonify(analysisIds)
+    except Exception as error:
+        return f"Failed to send request to perform computations: {error}", 500
+    return jsonify(analysisIds)
+
+
+def check_spreadsheets(user, spreadsheets):
     user_spreadsheets = [spreadsheet.id for spreadsheet in user.spreadsheets]
 
-    for spreadsheet in parameters["spreadsheets"]:
+    for spreadsheet in spreadsheets:
         if spreadsheet["spreadsheetId"] not in user_spreadsheets:
             raise KeyError
 
@@ -72,15 +130,69 @@ def submit_analysis(user):
         if not 0 <= spreadsheet["viewId"] <= currentViewId:
             raise KeyError
 
+
+def get_analysis_options(parameters):
+    """Validated options of an analysis from its submitted `parameters`"""
+
     compute_wave_properties = parameters.get("computeWaveProperties", False)
     if not isinstance(compute_wave_properties, bool):
-        raise ValueError
+        raise ValueError("computeWaveProperties must be a boolean")
+
+    # Candidate periods of the cosinor period scan
+    periods = parameters.get("periods")
+    if periods is not None and not (
+        isinstance(periods, list)
+        and periods
+        and all(
+            isinstance(period, (int, float))
+            and not isinstance(period, bool)
+            and 0 < period < float("inf")
+            for period in periods
+        )
+    ):
+        raise ValueError("periods must be a non-empty list of positive numbers")
+    if periods is not None and parameters["algorithm"] != "cosinor":
+        raise ValueError("periods are only supported by cosinor")
+
+    # Sequential permutations of UPSIDE, left out when not requested to keep the
+    # analysisIds of the other analyses
+    sequential_permutations = parameters.get("sequentialPermutations", False)
+    if not isinstance(sequential_permutations, bool):
+        raise ValueError("sequentialPermutations must be a boolean")
+    if sequential_permutations and parameters["algorithm"] != "upside":
+        raise ValueError("sequentialPermutations are only supported by upside")
+
+    options = {"computeWaveProperties": compute_wave_properties}
+
+    if periods is not None:
+        options["periods"] = periods
+
+    if sequential_permutations:
+        options["sequentialPermutations"] = True
+
+    return options
+
+
+@analysis_blueprint.route("/", methods=["post"])
+@ajax_requires_account_or_share
+def submit_analysis(user):
+    parameters = request.get_json()
+
+    if parameters["algorithm"] not in ALGORITHMS:
+        raise NotImplementedError
+
+    check_spreadsheets(user, parameters["spreadsheets"])
+
+    try:
+        options = get_analysis_options(parameters)
+    except ValueError as error:
+        return f"Invalid analysis options: {error}", 400
 
     analysis = {
         "userId": str(user.id),
         "algorithm": parameters["algorithm"],
         "spreadsheets": parameters["spreadsheets"],
-        "computeWaveProperties": compute_wave_properties,
+        **options,
     }
 
     if environment == "DEV":
@@ -89,6 +201,48 @@ def submit_analysis(user):
     return run(analysis)
 
 
+@analysis_blueprint.route("/batch", methods=["post"])
+@ajax_requires_account_or_share
+def submit_analyses(user):
+    """
+    Submit several analyses of the same spreadsheets, each with its algorithm and
+    options, to be run together; responds with their analysisIds in order
+    """
+
+    parameters = request.get_json()
+
+    analyses = []
+    for analysis_parameters in parameters["analyses"]:
+        if analysis_parameters["algorithm"] not in ALGORITHMS:
+            raise NotImplementedError
+
+        try:
+            options = get_analysis_options(analysis_parameters)
+        except ValueError as error:
+            return f"Invalid analysis options: {error}", 400
+
+        analyses.append(
+            {
+                "userId": str(user.id),
+                "algorithm": analysis_parameters["algorithm"],
+                "spreadsheets": parameters["spreadsheets"],
+                **options,
+            }
+        )
+
+    if not analyses:
+        raise ValueError
+
+    # The comparison algorithms run on several spreadsheets, the others on one
+    comparison = [analysis["algorithm"] in COMPARISON_ALGORITHMS for analysis in analyses]
+    if any(comparison) and not all(comparison):
+        raise ValueError
+
+    check_spreadsheets(user, parameters["spreadsheets"])
+
+    return run_all(analyses)
+
+
 @analysis_blueprint.route("/<analysisId>/results/url", methods=["get"])
 @ajax_requires_account_or_share
 def get_results_url(user, analysisId):
@@ -135,8 +289,7 @@ def get_analysis_status(user, analysisId):
         return "COMPLETED"
     except ClientError:
         try:
-            executionArn = f"{COMPUTATION_STATE_MACHINE_ARN.replace('stateMachine', 'execution')}:{analysisId}"
-            status = sfn.describe_execution(executionArn=executionArn)["status"]
+            status = get_execution_status(user.id, analysisId)
             if status == "RUNNING":
                 return "RUNNING"
             if status == "SUCCEEDED":
@@ -147,8 +300,35 @@ def get_analysis_status(user, analysisId):
             return "DOES_NOT_EXIST"
 
 
+def get_execution_status(userId, analysisId):
+    """
+    Status of the execution of an analysis, named after the analysis unless it was run
+    with others, in which case its parameters record the name of the execution
+    """
+
+    executions = COMPUTATION_STATE_MACHINE_ARN.replace("stateMachine", "execution")
+
+    try:
+        return sfn.describe_execution(executionArn=f"{executions}:{analysisId}")["status"]
+    except sfn.exceptions.ExecutionDoesNotExist:
+        try:
+            parameters = json.loads(get_analysis_parameters(userId, analysisId))
+        except ClientError:
+            parameters = {}
+
+        if "executionName" not in parameters:
+            raise
+
+    return sfn.describe_execution(
+        executionArn=f"{executions}:{parameters['executionName']}"
+    )["status"]
+
+
 def store_spreadsheet_to_s3(spreadsheet):
-    data = spreadsheet.get_raw_data().to_csv(header=False, index=False, na_rep="nan")
+    # Binary, so that the computation loads it without parsing
+    data = BytesIO()
+    np.save(data, spreadsheet.get_raw_data().to_numpy(dtype=float), allow_pickle=False)
+    data.seek(0)
 
     with open(spreadsheet.get_uploaded_file_path(), "rb") as original:
         s3.Object(
@@ -160,6 +340,7 @@ def store_spreadsheet_to_s3(spreadsheet):
 
     metadata = {
         "cycle_length": cycle_length,
+        "data_format": VIEW_DATA_FORMAT,
         "index": spreadsheet.get_ids(),
         "sample_collection_times": [
             t * cycle_length / spreadsheet.timepoints for t in spreadsheet.x_values
@@ -172,7 +353,7 @@ def store_spreadsheet_to_s3(spreadsheet):
     s3.Object(
         SPREADSHEET_BUCKET_NAME,
         f"{spreadsheet.user.id}/spreadsheets/{spreadsheet.id}/views/{viewId}/data",
-    ).upload_fileobj(BytesIO(data.encode()))
+    ).upload_fileobj(data)
 
     s3.Object(
         SPREADSHEET_BUCKET_NAME,